@@ -5,8 +5,8 @@
 # Imports
 
 import streamlit as st
-from PIL import Image
 import json
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
@@ -14,7 +14,20 @@ from datetime import datetime as dt, timedelta
 from streamlit_lottie import st_lottie_spinner
 from st_pages import show_pages, Page, show_pages_from_config
 
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bridge.aggregates import borough_means, change_series, entry_series
+from bridge.api import ResponseCache, start_server
+from bridge.assets import page_assets
+from bridge.baseline import ROLLING_DAYS, default_reference
+from bridge.data import chart_versions, intraday_versions
+from bridge.figures import FigureSkeletons, log_figure_size
+from bridge.intraday import BUCKET_LABELS
+from bridge.rollups import RESOLUTIONS, RESOLUTION_UNITS
+from bridge.sampling import Z_95
+from bridge.widgets import search_multiselect
 
 # import random
 # from itertools import cycle
@@ -26,10 +39,11 @@ import time
 # Page parameters
 
 # Set the page layout
-icon = Image.open("objects/bridge_icon.png")
+# Icon and CSS, optimized and loaded once per process (see bridge/assets.py)
+assets = page_assets()
 
 st.set_page_config(page_title="Bridge - NYC Subway Traffic Dataset",
-                   layout="wide", page_icon=icon)
+                   layout="wide", page_icon=assets.icon)
 # show_pages_from_config()
 # Renaming pages
 show_pages(
@@ -40,8 +54,51 @@ show_pages(
 )
 
 # Import all CSS configurations
-with open("filtered_style.css") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+st.markdown(assets.style, unsafe_allow_html=True)
+
+
+################################################
+################################################
+
+# Data Loading function
+
+# Data is loaded once per process by a version manager (see bridge/data.py), which reloads
+# it in the background when the source file changes
+
+# Threads computing exact results while the approximate ones are displayed, polled every
+# REFINE_POLL_SECONDS until they are done
+REFINE_POLL_SECONDS = 0.25
+
+@st.cache_resource()
+def load_refine_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="refine")
+
+
+# Take the current data version, kept for the whole rerun even if a new one is swapped in
+chart_snapshot = chart_versions().current()
+chart_data, filter_index, rollups, row_sample, point_sample, changes, stop_search = chart_snapshot.data
+refine_executor = load_refine_executor()
+
+# Exact results (futures) by data version, function and date range, shared by every rerun and session
+@st.cache_resource()
+def load_exact_results():
+    return ResponseCache(max_entries=32)
+
+exact_results = load_exact_results()
+
+# Memory-mapped intra-day entries (None until built with `python -m bridge.intraday`)
+intraday = intraday_versions().current().data
+
+# Figure layouts and styling, built once per process (see bridge/figures.py)
+@st.cache_resource()
+def load_figure_skeletons():
+    return FigureSkeletons()
+
+figure_skeletons = load_figure_skeletons()
+
+# Optional JSON API served from this process, over the same data (set BRIDGE_API_PORT to enable)
+if os.environ.get("BRIDGE_API_PORT"):
+    start_server(int(os.environ["BRIDGE_API_PORT"]))
 
 
 ################################################
@@ -50,13 +107,14 @@ with open("filtered_style.css") as f:
 # Sidebar parameters
 
 st.sidebar.write("# Parameters")
-initial_start_date = pd.to_datetime("01-01-2020")
-initial_end_date = pd.to_datetime("06-30-2020")
+# Date bounds come from the dataset
+initial_start_date = rollups.start
+initial_end_date = rollups.end
 
-# Initialize session_state variables
-if 'start_date' not in st.session_state:
+# Initialize session_state variables (and clamp them if a new data version moved the bounds)
+if 'start_date' not in st.session_state or not initial_start_date <= st.session_state.start_date < initial_end_date:
     st.session_state.start_date = initial_start_date
-if 'end_date' not in st.session_state:
+if 'end_date' not in st.session_state or not st.session_state.start_date < st.session_state.end_date <= initial_end_date:
     st.session_state.end_date = initial_end_date
 
 # Select boxes session states
@@ -70,19 +128,30 @@ if 'selected_division' not in st.session_state:
     st.session_state.selected_division = ''
 
 display_options = ['Time Series Chart', 'Borough Segmentation']
+if intraday is not None:
+    display_options.append('Time of Day')
 selected_display = st.sidebar.selectbox('Select display', display_options)
 
 st.sidebar.write("---")
 start_date = pd.to_datetime(st.sidebar.date_input('Start Date:', value=st.session_state.start_date,
-                                min_value=pd.to_datetime("01-01-2020"),
+                                min_value=initial_start_date,
                                 max_value=st.session_state.end_date - timedelta(days=1)))
 
 end_date = pd.to_datetime(st.sidebar.date_input('Select an end start:', value=st.session_state.end_date,
                                 min_value=start_date + timedelta(days=1),
-                                max_value=pd.to_datetime("06-30-2020")))
+                                max_value=initial_end_date))
+
+# Reference window of the pre-COVID baseline used by the percent change views
+reference = st.sidebar.date_input('Baseline period:', value=default_reference(changes.dates),
+                                  min_value=initial_start_date, max_value=initial_end_date)
+reference = tuple(pd.to_datetime(list(reference))) if len(reference) == 2 else default_reference(changes.dates)
 
 st.sidebar.text("")
 
+# Approximate preview: answer from the stratified samples first, refine once the page is drawn
+approximate = st.sidebar.checkbox('Approximate preview', value=False,
+                                  help='Show estimates from a sample first, then the exact values')
+
 # Update session_state variables
 st.session_state.start_date = start_date
 st.session_state.end_date = end_date
@@ -130,31 +199,32 @@ if selected_display == "Time Series Chart":
 ################################################
 ################################################
 
-# Data Loading function
-
-# Caching all these data loading functions in the start allows for faster page interaction
-st.cache_data()
-def load_chart_data():
-    # Load the data
-    data = pd.read_csv('input/clean_data.csv', low_memory=False)
-    date_format = "%Y-%m-%d"
-    data['date'] = pd.to_datetime(data['date'], format = date_format)
-    data = data[['stop_name', 'date', 'entries', 'line', 'borough', 'daytime_routes', 'division',
-        'structure', 'gtfs_longitude', 'gtfs_latitude']]
-
-    # Filter the data based on the selected date range
-    data['date'] = pd.to_datetime(data['date'])
-    data = data[data["date"].between(start_date, end_date)]
 
-    return data
+# Filter the data based on the selected date range
+data = chart_data[chart_data["date"].between(start_date, end_date)]
 
+# Exact results pending in the background: (placeholder, future, render function)
+refinements = []
 
-################################################
-################################################
+def refine_later(placeholder, future, render):
+    refinements.append((placeholder, future, render))
 
+def preview(sample):
+    # Estimates need a date block of every stratum in the range, shorter ranges are exact (and small)
+    return approximate and (end_date - start_date).days + 1 >= sample.block_rows
 
-# Load and cache the data that each function will copy
-data = load_chart_data()
+def exact(function):
+    # Future of function(data), submitted once per data version and date range. The selections
+    # are applied when rendering, so other clicks reuse the same (possibly already done) result.
+    key = (chart_snapshot.version, function.__name__, start_date, end_date)
+    future = exact_results.get(key)
+    if future is not None and future.done() and future.exception() is not None:
+        # A failed result is reported by this rerun only, the next one computes it again
+        exact_results.pop(key)
+    elif future is None:
+        future = refine_executor.submit(function, data)
+        exact_results.put(key, future)
+    return future
 
 # Chart rendering function
 
@@ -163,8 +233,6 @@ def render_df_chart():
     # Create a copy of the data for filtering
     filtered_data = data.copy()
 
-    total_entries = data.groupby(["date"])["entries"].sum().reset_index()
-
 
     # Create a dictionary to store the selected filter values
     selected_filters = {
@@ -177,125 +245,167 @@ def render_df_chart():
     # Create columns for select boxes
     column_list = st.columns([2,2,2,3])
 
-    activator = False
-
+    # Options of each select box come from the filter index given the upstream selections
     # Borough filter
-    filtered_boroughs = list(sorted(filtered_data['borough'].dropna().unique()))
+    filtered_boroughs = filter_index.options('borough', selected_filters)
     st.session_state.selected_borough = column_list[0].multiselect('Borough', filtered_boroughs, default=[])
-    if st.session_state.selected_borough:
-        filtered_data = filtered_data[filtered_data['borough'].isin(st.session_state.selected_borough)]
-        activator = True
+    selected_filters['borough'] = st.session_state.selected_borough
 
     # Division filter
-    filtered_divisions = list(sorted(filtered_data['division'].dropna().unique()))
+    filtered_divisions = filter_index.options('division', selected_filters)
     st.session_state.selected_division = column_list[1].multiselect('Division', filtered_divisions, default=[])
-    if st.session_state.selected_division:
-        filtered_data = filtered_data[filtered_data['division'].isin(st.session_state.selected_division)]
-        activator = True
+    selected_filters['division'] = st.session_state.selected_division
 
     # Line filter
-    filtered_lines = list(sorted(filtered_data['line'].dropna().unique()))
+    filtered_lines = filter_index.options('line', selected_filters)
     st.session_state.selected_line = column_list[2].multiselect('Line', filtered_lines, default=[])
-    if st.session_state.selected_line:
-        filtered_data = filtered_data[filtered_data['line'].isin(st.session_state.selected_line)]
-        activator = True
+    selected_filters['line'] = st.session_state.selected_line
 
-    # Stop name filter
-    filtered_stop_names = list(sorted(filtered_data['stop_name'].dropna().unique()))
-    st.session_state.selected_stop_name = column_list[3].multiselect('Stop Name', filtered_stop_names, default=[])
-    if st.session_state.selected_stop_name:
-        filtered_data = filtered_data[filtered_data['stop_name'].isin(st.session_state.selected_stop_name)]
-        activator = True
+    # Stop name filter, searched in the stop names still allowed by the other filters
+    with column_list[3]:
+        st.session_state.selected_stop_name = search_multiselect(
+            'Stop Name', stop_search, 'chart_stop_name',
+            allowed=filter_index.option_mask('stop_name', selected_filters))
+    selected_filters['stop_name'] = st.session_state.selected_stop_name
 
+    # Apply every selection at once through the station ids
+    activator = any(selected_filters.values())
+    if activator:
+        filtered_data = filtered_data[filter_index.row_mask(selected_filters, filtered_data['station_id'])]
 
-    filtered_data = filtered_data.sort_values(["line", "stop_name", "date"])
-
-    x1 = total_entries["date"]
-    y1 = total_entries["entries"]
 
-    fig = go.Figure()
+    filtered_data = filtered_data.sort_values(["line", "stop_name", "date"])
 
-    # Add the first line to the figure
-    fig.add_trace(go.Scatter(x=x1, y=y1,
-                             name="Total Entries",
-                             mode="lines", line=dict(color="#1c7575")))
+    df_display, chart_display = st.columns([4,5])
+    chart_title = chart_display.empty()
 
-    fig.update_layout(yaxis=dict(title="Total Entries"),
-                    width = 920, height=400,
-                    margin=dict(t=15, b=2, l=10, r=10),
-                    showlegend=True,
-                    legend=dict(x=1, y=.95, xanchor="right", yanchor="top"),
-                    plot_bgcolor="rgba(0,0,0,0)",
-                    paper_bgcolor="rgba(0,0,0,0)")
+    # Raw entries, or their rolling change against the baseline of the sidebar's reference period
+    show_change = chart_display.radio('Show', ['Entries', 'Change vs baseline'], horizontal=True) == 'Change vs baseline'
 
+    if show_change:
+        series = change_series(changes, filter_index, reference, start_date, end_date, selected_filters)
+        title = f"Change vs baseline ({ROLLING_DAYS}-day rolling, %)"
+        total_column, filtered_column = "total_change", "filtered_change"
+        total_title, filtered_title = "Total Change (%)", "Filtered Change (%)"
+    else:
+        # Resolution of the chart: "Auto" picks the finest rollup fitting the point budget
+        resolution_options = ["Auto"] + list(RESOLUTIONS.keys())
+        selected_resolution = chart_display.selectbox('Resolution', resolution_options)
+        if selected_resolution == "Auto":
+            selected_resolution = rollups.pick_resolution(start_date, end_date)
+
+        # Both series are read from the rollups instead of grouping the daily rows
+        series = entry_series(rollups, filter_index, selected_resolution, start_date, end_date, selected_filters)
+        title = f"Entries per {RESOLUTION_UNITS[selected_resolution]}"
+        total_column, filtered_column = "total_entries", "filtered_entries"
+        total_title, filtered_title = "Total Entries", "Filtered Entries"
+
+    # Static layout and styling, built once per process for each variant of the chart
+    def build_chart():
+        fig = go.Figure()
+
+        # Add the first line to the figure
+        fig.add_trace(go.Scatter(name=total_title,
+                                 mode="lines", line=dict(color="#1c7575")))
+
+        fig.update_layout(yaxis=dict(title=total_title),
+                        xaxis=dict(type="date"),
+                        width = 920, height=400,
+                        margin=dict(t=15, b=2, l=10, r=10),
+                        showlegend=True,
+                        legend=dict(x=1, y=.95, xanchor="right", yanchor="top"),
+                        plot_bgcolor="rgba(0,0,0,0)",
+                        paper_bgcolor="rgba(0,0,0,0)")
+
+        if activator:
+            # Add the second line to the figure with a separate y-axis (percentages share the first one)
+            fig.add_trace(go.Scatter(name=filtered_title,
+                                     mode="lines", line=dict(color="#e38a8a"),
+                                     yaxis="y" if show_change else "y2"))
+
+            # Update the layout to show the second y-axis
+            fig.update_layout(
+                yaxis=dict(title=total_title),
+                yaxis2=dict(title=filtered_title, visible=not show_change,
+                            side="right", overlaying="y", showgrid=False),
+                width = 920, height=400, margin=dict(t=0, b=0, l=0, r=0),
+                legend=dict(x=1, y=.95, xanchor="right", yanchor="top"),
+                plot_bgcolor="rgba(0,0,0,0)",
+                paper_bgcolor="rgba(0,0,0,0)",
+                        )
+        return fig
+
+    traces = [{"x": series["date"].to_numpy(), "y": series[total_column].to_numpy()}]
     if activator:
-        x2 = filtered_data["date"]
-        y2 = filtered_data.groupby(["date"])["entries"].sum()
-
-        # Add the second line to the figure with a separate y-axis
-        fig.add_trace(go.Scatter(x=x2, y=y2, name="Filtered Entries",
-                                 mode="lines", line=dict(color="#e38a8a"), yaxis="y2"))
-
-        # Update the layout to show the second y-axis
-        fig.update_layout(
-            yaxis=dict(title="Total Entries"),
-            yaxis2=dict(title="Filtered Entries",
-                        side="right", overlaying="y", showgrid=False),
-            width = 920, height=400, margin=dict(t=0, b=0, l=0, r=0),
-            legend=dict(x=1, y=.95, xanchor="right", yanchor="top"),
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="rgba(0,0,0,0)",
-                    )
+        traces.append({"x": series["date"].to_numpy(), "y": series[filtered_column].to_numpy()})
 
-    df_display, chart_display = st.columns([4,5])
+    fig = figure_skeletons.figure(("time_series", show_change, activator), build_chart, traces)
+    log_figure_size("time_series", fig)
 
     # Display the filtered dataframe and chart
     with df_display:
         st.write("#### Raw Data")
-        pretty_df = filtered_data.copy().reset_index(drop=True)
+        pretty_df = filtered_data.drop(columns='station_id').reset_index(drop=True)
         pretty_df["date"] = pretty_df["date"].dt.date
 
         st.write(pretty_df)
 
     with chart_display:
-        st.write("#### Entries per day")
+        chart_title.write(f"#### {title}")
         st.plotly_chart(fig, use_container_width=True)
 
-def render_bar():
-    # Load the data
-    data_b = data.copy()
+def render_bar_figure(placeholder, bar_data):
+    # Approximate data comes with an "error" column drawn as error bars
+    error = "error" if "error" in bar_data else None
 
-    # Group by borough and calculate the average daily entries
-    data_b['date'] = data_b['date'].dt.date
-    bar_data = data_b.groupby("borough", as_index=False)["entries"].mean()
-    bar_data['entries'] = bar_data['entries'].round(0).astype(int)
+    # Static part of the bar plot, built once per process
+    def build_bar():
+        return px.bar(pd.DataFrame({'borough': [''], 'entries': [0], 'error': [0]}),
+                      x='borough', y='entries', error_y=error,
+                      labels={'entries': 'Average Daily Entries', 'borough': 'Borough'},
+                      )
 
-    # Create the bar plot
-    fig_bar = px.bar(bar_data, x='borough', y='entries',
-                     labels={'entries': 'Average Daily Entries', 'borough': 'Borough'},
-                     )
+    trace = {"x": bar_data['borough'].tolist(), "y": bar_data['entries'].to_numpy()}
+    if error:
+        trace["error_y.array"] = bar_data[error].to_numpy()
 
     # Adjust y-axis range according to Manhattan
     if bar_data["entries"].max() > 15000 or bar_data["entries"].max() < 7000:
-        fig_bar.update_yaxes(range=[0, 1.1*bar_data["entries"].max()])
+        y_range = [0, 1.1*bar_data["entries"].max()]
     else:
-        fig_bar.update_yaxes(range=[0, 15000])
-
+        y_range = [0, 15000]
 
+    fig_bar = figure_skeletons.figure(("bar", error), build_bar, [trace], layout=dict(yaxis_range=y_range))
+    log_figure_size("bar", fig_bar)
 
     # Display the plot
-    st.plotly_chart(fig_bar, theme=None, use_container_width=True)
+    placeholder.plotly_chart(fig_bar, theme=None, use_container_width=True)
 
-def borough_sunburst():
+def render_bar():
+    placeholder = st.empty()
+    future = exact(borough_means)
 
-    # Load the data
-    data_s = data.copy()
+    if not preview(row_sample) or future.done():
+        render_bar_figure(placeholder, future.result())
+        return
 
-    col1, col2 = st.columns([4,3])
+    # Group by borough and estimate the average daily entries from the sample
+    estimates = row_sample.estimate("borough", start_date, end_date, kind="mean")
+    bar_data = pd.DataFrame({"borough": estimates["borough"],
+                             "entries": estimates["estimate"].round(0).astype(int),
+                             "error": Z_95 * estimates["stderr"]})
+    render_bar_figure(placeholder, bar_data)
+
+    # Replace with the exact means once they are computed
+    refine_later(placeholder, future, render_bar_figure)
 
+# Total entries of each station, computed in the background when the preview mode is on
+def station_totals(data):
+    return data.groupby(['borough', 'stop_name'])['entries'].sum().reset_index()
 
-    # Group the data by borough and station, and calculate the total entries for each station
-    df_borough = data_s.groupby(['borough', 'stop_name'])['entries'].sum().reset_index()
+def borough_sunburst():
+
+    col1, col2 = st.columns([4,3])
 
 
         # Create the dropdown menu for selecting the number of top stations to keep
@@ -312,63 +422,89 @@ def borough_sunburst():
             st.write("_Hint: Don't hesitate to click on a borough_")
             st.write("---")
 
-    with col1:
+    def render_sunburst_figure(placeholder, df_borough):
         # For each borough, get the top N stations by entries and combine the rest as "Others"
-        df_borough_top = pd.DataFrame()
-        for borough in df_borough['borough'].unique():
-            df_borough_b = df_borough[df_borough['borough'] == borough]
-            df_borough_b = df_borough_b.sort_values('entries', ascending=False)
-            df_borough_b_top = df_borough_b.head(top_n)
-            if len(df_borough_b) > top_n:
-                df_borough_b_other = pd.DataFrame({
-                    'borough': borough,
-                    'stop_name': ['Others'],
-                    'entries': [df_borough_b['entries'][top_n:].sum()]
-                })
-                df_borough_b_top = pd.concat([df_borough_b_top, df_borough_b_other])
-            df_borough_top = pd.concat([df_borough_top, df_borough_b_top])
-
-
-        color_sequence = ['#267d7a', '#4f267d', '#feefff', '#A83a50', 'black']
-        # Create the sunburst graph
-        fig = px.sunburst(df_borough_top, path=['borough', 'stop_name'], values='entries',
-                            color_discrete_sequence=color_sequence)
-
-        # Update the graph
-        fig.update_traces(textinfo='label+percent entry')
-        fig.update_layout(width=600, height=600,
-                        margin=dict(l=50, r=50, t=50, b=50), # Adjust the margins to leave space for the square
-                        plot_bgcolor="rgba(0,0,0,0)",
-                        paper_bgcolor="rgba(0,0,0,0)",
-                        shapes=[
-                            dict(
-                                type='rect',
-                                xref='paper',
-                                yref='paper',
-                                x0=-0.08,
-                                y0=-0.07,
-                                x1=1.08,
-                                y1=1.07,
-                                line=dict(
-                                    color='#ffffff',
-                                    width=5
-                                ),
-                        fillcolor='rgba(0,0,0,0)',  # Set fillcolor as transparent
-                        opacity=0.1
-                            )
-                        ]
-                    )
+        others = df_borough['stop_name'] == 'Others'
+        df_borough_ranked = df_borough[~others].sort_values(['borough', 'entries'], ascending=[True, False])
+        rank = df_borough_ranked.groupby('borough').cumcount()
+        df_borough_other = pd.concat([df_borough_ranked[rank >= top_n], df_borough[others]])
+        df_borough_other = df_borough_other.groupby('borough', as_index=False)['entries'].sum()
+        df_borough_other['stop_name'] = 'Others'
+        df_borough_top = pd.concat([df_borough_ranked[rank < top_n], df_borough_other]).sort_values('borough', kind='stable')
+
+        # Sunburst hierarchy: stations (and "Others") under their borough
+        df_borough_root = df_borough_top.groupby('borough', as_index=False)['entries'].sum()
+        ids = (df_borough_top['borough'] + '/' + df_borough_top['stop_name']).tolist() + df_borough_root['borough'].tolist()
+        labels = df_borough_top['stop_name'].tolist() + df_borough_root['borough'].tolist()
+        parents = df_borough_top['borough'].tolist() + [''] * len(df_borough_root)
+        values = pd.concat([df_borough_top['entries'], df_borough_root['entries']]).to_numpy()
+
+        # Static part of the sunburst graph, built once per process
+        def build_sunburst():
+            color_sequence = ['#267d7a', '#4f267d', '#feefff', '#A83a50', 'black']
+            # Create the sunburst graph
+            fig = px.sunburst(pd.DataFrame({'borough': [''], 'stop_name': [''], 'entries': [1]}),
+                                path=['borough', 'stop_name'], values='entries',
+                                color_discrete_sequence=color_sequence)
+
+            # Update the graph
+            fig.update_traces(textinfo='label+percent entry')
+            fig.update_layout(width=600, height=600,
+                            margin=dict(l=50, r=50, t=50, b=50), # Adjust the margins to leave space for the square
+                            plot_bgcolor="rgba(0,0,0,0)",
+                            paper_bgcolor="rgba(0,0,0,0)",
+                            shapes=[
+                                dict(
+                                    type='rect',
+                                    xref='paper',
+                                    yref='paper',
+                                    x0=-0.08,
+                                    y0=-0.07,
+                                    x1=1.08,
+                                    y1=1.07,
+                                    line=dict(
+                                        color='#ffffff',
+                                        width=5
+                                    ),
+                            fillcolor='rgba(0,0,0,0)',  # Set fillcolor as transparent
+                            opacity=0.1
+                                )
+                            ]
+                        )
+            return fig
+
+        fig = figure_skeletons.figure("sunburst", build_sunburst,
+                                      [{"ids": ids, "labels": labels, "parents": parents, "values": values}])
+        log_figure_size("sunburst", fig)
 
         # Display the sunburst graph in the Streamlit app
-        st.plotly_chart(fig)
+        placeholder.plotly_chart(fig)
 
-def render_scatter():
+    placeholder = col1.empty()
+    future = exact(station_totals)
+
+    if not preview(row_sample) or future.done():
+        render_sunburst_figure(placeholder, future.result())
+        return
 
-        data_sc = data.copy()
+    # Station totals estimated from the sampled rows first, then the exact ones. Stations without
+    # a sampled row in the range are counted in "Others", at their sampled mean over every date.
+    estimates = row_sample.estimate("station_id", start_date, end_date, kind="total").set_index("station_id")
+    means = row_sample.rows.groupby("station_id")["entries"].mean() * ((end_date - start_date).days + 1)
+    df_borough = filter_index.stations[["borough", "stop_name"]].copy()
+    df_borough['entries'] = estimates["estimate"].reindex(df_borough.index).fillna(means).fillna(0).round(0)
+    df_borough.loc[~df_borough.index.isin(estimates.index), 'stop_name'] = 'Others'
+    render_sunburst_figure(placeholder, station_totals(df_borough))
 
-        data['day_of_week'] = data['date'].dt.day_name()
+    refine_later(placeholder, future, render_sunburst_figure)
 
-        scatter_data = data.groupby(["stop_name", "date", "day_of_week", "borough"], as_index=False)["entries"].sum()
+# Exact station-day points, computed in the background when the preview mode is on
+def scatter_points(data):
+    scatter_data = data.groupby(["stop_name", "date", "borough"], as_index=False)["entries"].sum()
+    scatter_data['day_of_week'] = scatter_data['date'].dt.day_name()
+    return scatter_data
+
+def render_scatter():
 
         days_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
@@ -381,63 +517,151 @@ def render_scatter():
         # Multiselect box for boroughs and stop names
         column_list = st.columns(2)
 
-        # Filter scatter_data based on the selected days
-        filtered_data = scatter_data[scatter_data['day_of_week'].isin(selected_days)]
+        # Rows of the selected dates and days of the week, the options only list stations with one
+        day_numbers = [days_of_week.index(day) for day in selected_days]
+        row_mask = (chart_data['date'].between(start_date, end_date) & chart_data['date'].dt.dayofweek.isin(day_numbers)).to_numpy()
 
         # Borough filter
-        filtered_boroughs = list(sorted(filtered_data['borough'].dropna().unique()))
+        filtered_boroughs = filter_index.options('borough', {}, row_mask)
         st.session_state.selected_borough = column_list[0].multiselect('Borough', filtered_boroughs, default=[])
-        if st.session_state.selected_borough:
-            filtered_data = filtered_data[filtered_data['borough'].isin(st.session_state.selected_borough)]
 
+        # Stop name filter, searched in the stop names of the selected boroughs
+        with column_list[1]:
+            st.session_state.selected_stop_name = search_multiselect(
+                'Stop Name', stop_search, 'scatter_stop_name',
+                allowed=filter_index.option_mask('stop_name', {'borough': st.session_state.selected_borough}, row_mask))
+
+        selected_boroughs = st.session_state.selected_borough
+        selected_stop_names = st.session_state.selected_stop_name
+
+        def render_scatter_figure(placeholder, scatter_data):
+
+            # Filter scatter_data based on the selected days, boroughs and stop names
+            filtered_data = scatter_data[scatter_data['day_of_week'].isin(selected_days)]
+            if selected_boroughs:
+                filtered_data = filtered_data[filtered_data['borough'].isin(selected_boroughs)]
+            if selected_stop_names:
+                filtered_data = filtered_data[filtered_data['stop_name'].isin(selected_stop_names)]
+
+            # Static part of the scatter plot, one trace per day of the week, built once per process
+            def build_scatter():
+                fig = px.scatter(pd.DataFrame({'stop_name': [''] * 7, 'entries': [0] * 7, 'day_of_week': days_of_week}),
+                                 x='stop_name', y='entries', color='day_of_week',
+                                 labels={'entries': 'Daily Entries', 'stop_name': ''},  # Adjust marker size based on the number of entries
+                                 category_orders={'day_of_week': days_of_week},
+                                 color_continuous_scale='Viridis'  # Choose a color scale for intensity
+                                 )
+
+                fig.update_traces(marker=dict(line=dict(width=1, color='Gray')))
+
+                fig.update_layout(
+                    autosize=True,
+                    width=1200,  # Set the width of the plot
+                    height=600,  # Set the height of the plot
+                    plot_bgcolor="#613B77",
+                    xaxis=dict(
+                        title_standoff=0
+                    ),
+                    legend=dict(
+                        title=dict(text='Day of Week'),
+                        bgcolor='rgba(0,0,0,0)',
+                        bordercolor='gray',
+                        borderwidth=1,
+                    ),
+                    margin=dict(l=80, r=50, t=20, b=150),
+                )
+                return fig
+
+            # Points of each day, days without points are left out of the legend
+            by_day = dict(tuple(filtered_data.groupby('day_of_week')))
+            traces = [{"x": by_day[day]['stop_name'].tolist(), "y": by_day[day]['entries'].to_numpy()}
+                      if day in by_day else None for day in days_of_week]
+
+            # Preview: tell how much of the points are shown
+            subtitle = 'Stations'
+            if '_weight' in scatter_data:
+                subtitle = f'Stations (preview: {point_sample.rate:.0%} stratified sample of the station-days)'
+
+            fig = figure_skeletons.figure("scatter", build_scatter, traces, layout=dict(
+                annotations=[
+                        dict(
+                            x=0.5,  # X-coordinate of the annotation (midpoint of x-axis)
+                            y=0,  # Y-coordinate of the annotation (below the plot)
+                            text=subtitle,  # Text of the annotation
+                            showarrow=False,  # Hide the arrow
+                            xref='paper',  # Set the x-coordinate reference to 'paper' (relative to the entire plot)
+                            yref='paper',  # Set the y-coordinate reference to 'paper' (relative to the entire plot)
+                            font=dict(color='white', size=14)  # Set the font color and size
+                        )
+                ]
+            ))
+            log_figure_size("scatter", fig)
+
+            placeholder.plotly_chart(fig, theme=None, use_container_width=True)
+
+        placeholder = st.empty()
+        future = exact(scatter_points)
+
+        if not approximate or future.done():
+            render_scatter_figure(placeholder, future.result())
+            return
+
+        # Draw the sampled station-days first, then the exact points once they are computed
+        sampled_points = point_sample.between(start_date, end_date)
+        sampled_points = sampled_points.assign(day_of_week=sampled_points['date'].dt.day_name())
+        render_scatter_figure(placeholder, sampled_points)
+
+        refine_later(placeholder, future, render_scatter_figure)
+
+
+# Entries of each 4-hour bucket of each day, for the selected stations
+def render_heatmap():
+
+        column_list = st.columns([2, 2, 1])
 
-        # Stop name filter
-        filtered_stop_names = list(sorted(filtered_data['stop_name'].dropna().unique()))
-        st.session_state.selected_stop_name = column_list[1].multiselect('Stop Name', filtered_stop_names, default=[])
-        if st.session_state.selected_stop_name:
-            filtered_data = filtered_data[filtered_data['stop_name'].isin(st.session_state.selected_stop_name)]
-
-
-
-
-        fig = px.scatter(filtered_data, x='stop_name', y='entries', color='day_of_week',
-                         labels={'entries': 'Daily Entries', 'stop_name': ''},  # Adjust marker size based on the number of entries
-                         color_continuous_scale='Viridis'  # Choose a color scale for intensity
-                         )
-
-        fig.update_traces(marker=dict(line=dict(width=1, color='Gray')))
-
-        fig.update_layout(
-            autosize=True,
-            width=1200,  # Set the width of the plot
-            height=600,  # Set the height of the plot
-            plot_bgcolor="#613B77",
-            xaxis=dict(
-                title_standoff=0
-            ),
-            legend=dict(
-                title=dict(text='Day of Week'),
-                bgcolor='rgba(0,0,0,0)',
-                bordercolor='gray',
-                borderwidth=1,
-            ),
-            margin=dict(l=80, r=50, t=20, b=150),
-            annotations=[
-                    dict(
-                        x=0.5,  # X-coordinate of the annotation (midpoint of x-axis)
-                        y=0,  # Y-coordinate of the annotation (below the plot)
-                        text='Stations',  # Text of the annotation
-                        showarrow=False,  # Hide the arrow
-                        xref='paper',  # Set the x-coordinate reference to 'paper' (relative to the entire plot)
-                        yref='paper',  # Set the y-coordinate reference to 'paper' (relative to the entire plot)
-                        font=dict(color='white', size=14)  # Set the font color and size
-                    )
-            ]
-
-        )
-
+        # Borough filter
+        heatmap_boroughs = column_list[0].multiselect('Borough', filter_index.options('borough', {}),
+                                                      default=[], key='heatmap_borough')
+
+        # Stop name filter, searched in the stop names of the selected boroughs
+        with column_list[1]:
+            heatmap_stop_names = search_multiselect(
+                'Stop Name', stop_search, 'heatmap_stop_name',
+                allowed=filter_index.option_mask('stop_name', {'borough': heatmap_boroughs}))
+
+        # Raw entries, or the share of each bucket in the day (shifts in the time of travel)
+        show_share = column_list[2].radio('Show', ['Entries', 'Share of the day'], key='heatmap_show') == 'Share of the day'
+
+        # Selected stations, those of the selected boroughs, or every station (pre-summed)
+        stations = heatmap_stop_names or None
+        if stations is None and heatmap_boroughs:
+            stations = filter_index.options('stop_name', {'borough': heatmap_boroughs})
+
+        heatmap = intraday.heatmap(stations, start_date, end_date)
+        values = heatmap.to_numpy()
+        if show_share:
+            day_totals = values.sum(axis=0)
+            values = 100 * values / np.where(day_totals > 0, day_totals, np.nan)
+
+        # Static part of the heatmap, built once per process
+        def build_heatmap():
+            fig = go.Figure(go.Heatmap(colorscale="purples_r",
+                                       colorbar=dict(title="Share (%)" if show_share else "Entries"),
+                                       hovertemplate="%{x|%Y-%m-%d} %{y}<br>%{z:,.0f}<extra></extra>"))
+
+            fig.update_layout(xaxis=dict(type="date"),
+                              yaxis=dict(type="category", autorange="reversed"),
+                              width=1200, height=400,
+                              margin=dict(t=15, b=2, l=10, r=10),
+                              plot_bgcolor="rgba(0,0,0,0)",
+                              paper_bgcolor="rgba(0,0,0,0)")
+            return fig
+
+        fig = figure_skeletons.figure(("heatmap", show_share), build_heatmap,
+                                      [{"x": heatmap.columns, "y": BUCKET_LABELS, "z": values}])
+        log_figure_size("heatmap", fig)
 
-        st.plotly_chart(fig, theme=None, use_container_width=True)
+        st.plotly_chart(fig, use_container_width=True)
 
 
 # Create a Streamlit menu to choose the display
@@ -466,6 +690,25 @@ if selected_display == "Borough Segmentation":
         st.write("### Average Station Daily Entries per Borough")
         render_bar()
 
+if selected_display == "Time of Day":
+    st.write("### Entries by time of day")
+    st.write("_Turnstiles are read about every 4 hours: each cell sums the entries of one 4-hour bucket_")
+    render_heatmap()
+
+
+# Swap the approximate charts for the exact ones that are done. The others are polled: the page
+# reruns shortly and finds them in exact_results, and a click meanwhile starts its own rerun
+pending = False
+for placeholder, future, render in refinements:
+    if future.done():
+        render(placeholder, future.result())
+    else:
+        pending = True
+
+if pending:
+    time.sleep(REFINE_POLL_SECONDS)
+    st.rerun()
+
 
 with st.sidebar:
     st.write("---")
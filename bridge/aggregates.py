@@ -0,0 +1,73 @@
+import pandas as pd
+
+
+################################################
+################################################
+
+# Aggregates shared by the pages and the API
+
+
+# Time series: entries per period over all stations, and over the selected ones
+def entry_series(rollups, filter_index, resolution, start, end, selections):
+    series = pd.DataFrame({"total_entries": rollups.series(resolution, start, end)})
+    if any(selections.values()):
+        station_mask = filter_index.station_mask(selections)
+        filtered = rollups.series(resolution, start, end, station_mask=station_mask)
+        series["filtered_entries"] = filtered.reindex(series.index, fill_value=0)
+    return series.rename_axis("date").reset_index()
+
+
+# Time series: rolling percent change against the baseline, over all stations and the selected ones
+def change_series(changes, filter_index, reference, start, end, selections):
+    series = pd.DataFrame({"total_change": changes.change(reference, combine=True)})
+    if any(selections.values()):
+        station_mask = filter_index.station_mask(selections)
+        series["filtered_change"] = changes.change(reference, columns=station_mask, combine=True)
+    series = series[(series.index >= start) & (series.index <= end)]
+    return series.rename_axis("date").reset_index()
+
+
+# Average daily entries per borough
+def borough_means(data):
+    bar_data = data.groupby("borough", as_index=False)["entries"].mean()
+    bar_data['entries'] = bar_data['entries'].round(0).astype(int)
+    return bar_data
+
+
+# Neighborhood map: daily NTA rows in the date range and selected boroughs
+def filter_nta(map_df, start_date, end_date, boroughs):
+    filtered_map_df = map_df[map_df["date"].between(start_date, end_date)]
+    if boroughs:
+        filtered_map_df = filtered_map_df[filtered_map_df['borough'].isin(boroughs)]
+    return filtered_map_df
+
+# Group the dataframe to map all selected fields over the date interval (entries summed or averaged)
+def aggregate_nta(filtered_map_df, exclude=(), entries_agg="sum"):
+    filtered_map_df = filtered_map_df[~filtered_map_df['NTAName'].isin(exclude)]
+
+    filtered_map_df = filtered_map_df.groupby("NTACode").agg({
+        'NTAName': 'first',
+        'borough': 'first',
+        'entries': entries_agg,
+        'population': 'last',
+        'entries_ratio': 'mean',
+        'geometry': 'first'}).reset_index()
+
+    # Reordering columns
+    return filtered_map_df[["NTAName", "borough", "entries",
+                            "population", "entries_ratio", "NTACode",
+                            "geometry"]]
+
+
+# Dynamic map: entries of one day at each station location
+def station_day_counts(coords, counts_df, date):
+    return station_counts(coords, counts_df.loc[pd.Timestamp(date)])
+
+def station_counts(coords, counts):
+    # Stations with their counts (Series by stop name), and the largest count
+    counts = counts.rename("counts")
+
+    display_counts = coords.merge(counts, left_on="stop_name", right_index=True, how="left")
+    display_counts = display_counts[~pd.isna(display_counts["counts"])].reset_index(drop=True)
+
+    return display_counts, counts.max()
@@ -0,0 +1,259 @@
+import argparse
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from bridge.aggregates import aggregate_nta, borough_means, entry_series, filter_nta, station_day_counts
+from bridge.data import chart_versions, nta_versions, station_versions
+from bridge.filters import FILTER_COLUMNS
+from bridge.rollups import RESOLUTIONS
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Read-only JSON API over the same data layer as the pages
+#
+# Run it alongside Streamlit with `python -m bridge.api`, or set BRIDGE_API_PORT to serve it
+# from the Streamlit process itself. Every endpoint takes `start` and `end` (YYYY-MM-DD) and
+# list filters as repeated or comma-separated parameters, e.g. `?borough=Bronx,Queens`.
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8502
+
+# Number of serialized responses kept in memory
+CACHE_SIZE = 512
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    # LRU cache of response bodies, keyed by ETag
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+
+################################################
+################################################
+
+# Query parameters
+
+def _list(params, name):
+    values = []
+    for value in params.get(name, []):
+        values += [v for v in value.split(",") if v]
+    return values
+
+def _value(params, name, default=None):
+    values = params.get(name)
+    return values[-1] if values else default
+
+def _date(params, name, default):
+    value = _value(params, name)
+    if value is None:
+        return default
+    try:
+        return pd.to_datetime(value, format="%Y-%m-%d")
+    except ValueError:
+        raise ApiError(400, f"'{name}' must be a date formatted as YYYY-MM-DD")
+
+def _records(frame):
+    # JSON-ready rows, dates as YYYY-MM-DD
+    frame = frame.copy()
+    for col in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[col]):
+            frame[col] = frame[col].dt.strftime("%Y-%m-%d")
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+
+
+################################################
+################################################
+
+# Endpoints: each one takes a data snapshot and the query parameters and returns a JSON-able dict
+
+def daily_totals(snapshot, params):
+    chart_data, filter_index, rollups, row_sample, point_sample, changes, stop_search = snapshot.data
+    start = _date(params, "start", rollups.start)
+    end = _date(params, "end", rollups.end)
+
+    resolution = _value(params, "resolution", "auto").capitalize()
+    if resolution == "Auto":
+        resolution = rollups.pick_resolution(start, end)
+    if resolution not in RESOLUTIONS:
+        raise ApiError(400, f"'resolution' must be one of auto, {', '.join(RESOLUTIONS).lower()}")
+
+    selections = {col: _list(params, col) for col in FILTER_COLUMNS}
+    series = entry_series(rollups, filter_index, resolution, start, end, selections)
+
+    return {"resolution": resolution.lower(), "data": _records(series)}
+
+def borough_mean_entries(snapshot, params):
+    chart_data = snapshot.data[0]
+    start = _date(params, "start", chart_data["date"].min())
+    end = _date(params, "end", chart_data["date"].max())
+
+    data = chart_data[chart_data["date"].between(start, end)]
+    return {"data": _records(borough_means(data))}
+
+def nta_aggregates(snapshot, params):
+    map_df = snapshot.data[0]
+    start = _date(params, "start", map_df["date"].min())
+    end = _date(params, "end", map_df["date"].max())
+
+    entries_agg = _value(params, "agg", "sum")
+    if entries_agg not in ("sum", "mean"):
+        raise ApiError(400, "'agg' must be sum or mean")
+
+    filtered_map_df = filter_nta(map_df, start, end, _list(params, "borough"))
+    nta = aggregate_nta(filtered_map_df, _list(params, "exclude"), entries_agg)
+
+    # Polygons are large, only sent when asked for
+    if _value(params, "geometry", "0") != "1":
+        nta = nta.drop(columns="geometry")
+    return {"data": _records(nta)}
+
+def station_day(snapshot, params):
+    data, coords, counts_df, spatial_bins, changes = snapshot.data
+    date = _date(params, "date", None)
+    if date is None:
+        raise ApiError(400, "'date' is required")
+    if date not in counts_df.index:
+        raise ApiError(404, f"No data for {date:%Y-%m-%d}")
+
+    # Stations, or grid bins of `cell_size` meters
+    cell_size = _value(params, "cell_size")
+    if cell_size is None:
+        frame, max_entry = station_day_counts(coords, counts_df, date)
+        return {"data": _records(frame)}
+
+    if not cell_size.isdigit() or int(cell_size) not in spatial_bins.grids:
+        raise ApiError(400, f"'cell_size' must be one of {', '.join(map(str, spatial_bins.cell_sizes))}")
+    frame = spatial_bins.frame(int(cell_size), date).drop(columns="color")
+    return {"cell_size": int(cell_size), "data": _records(frame)}
+
+# Path -> (version manager, endpoint)
+ENDPOINTS = {
+    "/api/daily_totals": (chart_versions, daily_totals),
+    "/api/borough_means": (chart_versions, borough_mean_entries),
+    "/api/nta": (nta_versions, nta_aggregates),
+    "/api/station_day": (station_versions, station_day),
+}
+
+
+################################################
+################################################
+
+# Server
+
+class ApiHandler(BaseHTTPRequestHandler):
+    cache = ResponseCache()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in ENDPOINTS:
+            return self._send_json(404, {"error": f"Unknown endpoint {url.path}",
+                                         "endpoints": sorted(ENDPOINTS)})
+
+        versions, endpoint = ENDPOINTS[url.path]
+        snapshot = versions().current()
+        params = parse_qs(url.query)
+
+        # The response only depends on the data version and the query: the ETag is known
+        # before computing anything, so revalidations and cache hits cost a hash
+        canonical = json.dumps(sorted(params.items()))
+        etag = '"' + hashlib.sha1(f"{url.path}|{canonical}|{snapshot.version}".encode()).hexdigest()[:20] + '"'
+
+        if etag in self.headers.get("If-None-Match", ""):
+            return self._send(304, b"", etag)
+
+        body = self.cache.get(etag)
+        if body is None:
+            try:
+                payload = endpoint(snapshot, params)
+            except ApiError as e:
+                return self._send_json(e.status, {"error": str(e)})
+            payload["version"] = snapshot.version
+            body = json.dumps(payload).encode()
+            self.cache.put(etag, body)
+
+        self._send(200, body, etag)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload).encode())
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_server(port=DEFAULT_PORT, host=DEFAULT_HOST):
+    # Serve the API from a background thread, once per process
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), ApiHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True, name="bridge-api").start()
+            logger.info("Serving the JSON API on http://%s:%d", host, port)
+        return _server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only JSON API over the Bridge aggregates")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = ThreadingHTTPServer((args.host, args.port), ApiHandler)
+    server.daemon_threads = True
+    logger.info("Serving the JSON API on http://%s:%d", args.host, args.port)
+    server.serve_forever()
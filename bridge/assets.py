@@ -0,0 +1,229 @@
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Static assets: page icon, CSS and the images it references
+#
+# The CSS is minified and every local file it references is optimized, written under a
+# fingerprinted name to the Streamlit static folder (served at app/static/, see
+# .streamlit/config.toml) and the reference rewritten. That route sends no Cache-Control header,
+# so browsers still revalidate: the fingerprint only makes a changed file get a new URL.
+# Everything is built and loaded once per process, `python -m bridge.assets` builds ahead of time.
+
+STYLE_PATH = 'filtered_style.css'
+ICON_PATH = 'objects/bridge_icon.png'
+
+STATIC_DIR = 'static'
+STATIC_URL = 'app/static'
+MANIFEST_NAME = 'manifest.json'
+
+# Side of the page icon, in pixels
+ICON_SIZE = 64
+
+# Embedded SVG bitmaps are kept at this multiple of the SVG size, with at most this many colors
+SVG_PIXEL_RATIO = 2
+SVG_COLORS = 256
+
+
+def fingerprint(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+def fingerprinted_name(path, content):
+    # "objects/bridge.svg" -> "bridge.<hash>.svg"
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f"{stem}.{fingerprint(content)}{ext}"
+
+
+################################################
+################################################
+
+# Minifiers and optimizers
+
+def minify_css(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+def optimize_png(raw, max_size=None, colors=None):
+    # Downscaled to fit `max_size`, reduced to a palette of `colors` (RGB only) and re-encoded;
+    # the original is kept if nothing was gained
+    image = Image.open(io.BytesIO(raw))
+    if max_size:
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+    if colors and image.mode == "RGB":
+        image = image.quantize(colors)
+
+    out = io.BytesIO()
+    image.save(out, "PNG", optimize=True)
+    return out.getvalue() if len(out.getvalue()) < len(raw) else raw
+
+def optimize_svg(text, pixel_ratio=SVG_PIXEL_RATIO, colors=SVG_COLORS):
+    # Embedded PNGs are optimized once each and every repeat of an <image> tag (same attributes
+    # apart from its id) becomes a <use> reference to the first one, given an id if it had none;
+    # whitespace between tags is dropped
+    size = re.search(r'<svg\b[^>]*?\swidth="([\d.]+)"[^>]*?\sheight="([\d.]+)"', text)
+    max_size = int(pixel_ratio * max(float(size.group(1)), float(size.group(2)))) if size else None
+
+    optimized = {}
+    first_ids = {}
+
+    def embed(match):
+        payload = match.group(1)
+        if payload not in optimized:
+            raw = optimize_png(base64.b64decode(payload), max_size, colors)
+            optimized[payload] = base64.b64encode(raw).decode()
+        return f"data:image/png;base64,{optimized[payload]}"
+
+    def image(match):
+        tag = match.group(0)
+        tag_id = re.search(r'\sid="([^"]+)"', tag)
+        content = fingerprint(re.sub(r'\sid="[^"]+"', "", tag).encode())
+        if content in first_ids:
+            # A repeat keeps its own id, in case something references it
+            own_id = f' id="{tag_id.group(1)}"' if tag_id else ""
+            return f'<use{own_id} xlink:href="#{first_ids[content]}"/>'
+
+        if tag_id is None:
+            first_ids[content] = f"image-{content}"
+            tag = re.sub(r"^<image\b", f'<image id="{first_ids[content]}"', tag)
+        else:
+            first_ids[content] = tag_id.group(1)
+        return re.sub(r"data:image/png;base64,([^\"]*)", embed, tag)
+
+    text = re.sub(r"<image\b[^>]*/>", image, text)
+    return re.sub(r">\s+<", "><", text).strip()
+
+
+# Optimizer of each kind of file referenced by the CSS
+OPTIMIZERS = {
+    ".svg": lambda raw: optimize_svg(raw.decode()).encode(),
+    ".png": optimize_png,
+}
+
+
+################################################
+################################################
+
+# Build
+
+def write_static(directory, name, content):
+    # Written atomically, fingerprinted files never change once written
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def build_static(path, directory=STATIC_DIR, manifest=None):
+    # Fingerprinted name of the optimized file, reused from the manifest while the source is unchanged
+    with open(path, "rb") as f:
+        raw = f.read()
+    source = fingerprint(raw)
+
+    manifest = {} if manifest is None else manifest
+    entry = manifest.get(path)
+    if entry and entry["source"] == source and os.path.exists(os.path.join(directory, entry["file"])):
+        return entry["file"]
+
+    optimizer = OPTIMIZERS.get(os.path.splitext(path)[1].lower())
+    content = optimizer(raw) if optimizer else raw
+    name = fingerprinted_name(path, content)
+    write_static(directory, name, content)
+
+    logger.info("Built %s -> %s (%d -> %d bytes)", path, name, len(raw), len(content))
+    manifest[path] = {"source": source, "file": name}
+    return name
+
+def build_style(path=STYLE_PATH, directory=STATIC_DIR, manifest=None):
+    # Minified CSS with its local url() references pointing to the fingerprinted files
+    with open(path) as f:
+        css = minify_css(f.read())
+
+    def static_url(match):
+        target = match.group(2)
+        if re.match(r"^(data:|https?:|//|/)", target) or not os.path.exists(target):
+            return match.group(0)
+        try:
+            return f"url('{STATIC_URL}/{build_static(target, directory, manifest)}')"
+        except OSError:
+            logger.warning("Could not build %s, kept as is", target)
+            return match.group(0)
+
+    return re.sub(r"url\((['\"]?)([^'\")]+)\1\)", static_url, css)
+
+def load_icon(path=ICON_PATH, size=ICON_SIZE):
+    # Page icon, downscaled and fully loaded in memory
+    with open(path, "rb") as f:
+        icon = Image.open(io.BytesIO(optimize_png(f.read(), size)))
+    icon.load()
+    return icon
+
+Assets = namedtuple("Assets", ["icon", "style"])
+
+def build_assets(directory=STATIC_DIR):
+    manifest = _read_manifest(directory)
+    style = f"<style>{build_style(STYLE_PATH, directory, manifest)}</style>"
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+    except OSError:
+        logger.warning("Could not write the asset manifest to %s", directory)
+
+    return Assets(load_icon(), style)
+
+
+################################################
+################################################
+
+# Process-wide assets
+
+_assets = None
+_assets_lock = threading.Lock()
+
+def page_assets():
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            _assets = build_assets()
+        return _assets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the optimized, fingerprinted static assets")
+    parser.add_argument("--directory", default=STATIC_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_assets(args.directory)
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+################################################
+################################################
+
+# Pre-COVID baseline and percent change
+
+# Default reference window: the first 8 weeks of data (January and February 2020)
+DEFAULT_REFERENCE_DAYS = 56
+
+# Days of the rolling window used for the percent change
+ROLLING_DAYS = 7
+
+# Reference windows whose expected entries are kept by each engine
+CACHED_REFERENCES = 4
+
+
+def default_reference(dates):
+    start = dates.min()
+    return start, min(start + pd.Timedelta(days=DEFAULT_REFERENCE_DAYS - 1), dates.max())
+
+
+def rolling_sum(values, window):
+    # Sum over the last `window` rows (fewer at the start), along the first axis
+    cumulative = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    rows = np.arange(len(values))
+    return cumulative[rows + 1] - cumulative[np.maximum(rows + 1 - window, 0)]
+
+
+class ChangeEngine:
+    # Day-of-week adjusted baseline of every entity (station, NTA, ...) from a reference window,
+    # and percent change of the entries against it. Works on a (day x entity) matrix at once,
+    # the expected entries of the last few reference windows are cached (LRU).
+
+    def __init__(self, matrix, cached_references=CACHED_REFERENCES):
+        matrix = matrix.sort_index()
+        self.dates = pd.DatetimeIndex(matrix.index)
+        self.columns = matrix.columns
+        self.values = matrix.to_numpy(dtype=float)
+        self.weekday = self.dates.dayofweek.to_numpy()
+
+        # Days without data are left out of both the actual and the expected entries
+        self.observed = ~np.isnan(self.values)
+        self.actual = np.where(self.observed, self.values, 0)
+
+        self.cached_references = cached_references
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def baseline(self, reference):
+        # Mean entries of each entity for each day of the week over the reference window (7 x entity)
+        ref_start, ref_end = reference
+        in_reference = (self.dates >= ref_start) & (self.dates <= ref_end)
+
+        baseline = np.full((7, len(self.columns)), np.nan)
+        for day in range(7):
+            rows = in_reference & (self.weekday == day)
+            if rows.any():
+                baseline[day] = np.nanmean(self.values[rows], axis=0)
+        return baseline
+
+    def expected(self, reference):
+        # Expected entries of every (day, entity) under the baseline, zero where nothing was observed
+        # Least recently used windows are dropped past `cached_references`
+        key = (pd.Timestamp(reference[0]), pd.Timestamp(reference[1]))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            expected = np.nan_to_num(self.baseline(key)[self.weekday])
+            self._cache[key] = np.where(self.observed, expected, 0)
+            while len(self._cache) > self.cached_references:
+                self._cache.popitem(last=False)
+            return self._cache[key]
+
+    def _select(self, columns):
+        if columns is None:
+            return slice(None)
+        if isinstance(columns, np.ndarray) and columns.dtype == bool:
+            return columns
+        return self.columns.get_indexer(columns)
+
+    def change(self, reference, columns=None, combine=False, window=ROLLING_DAYS):
+        # Rolling percent change against the baseline, per entity or for the selected entities combined
+        selection = self._select(columns)
+        actual = self.actual[:, selection]
+        expected = self.expected(reference)[:, selection]
+        if combine:
+            actual, expected = actual.sum(axis=1), expected.sum(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = 100 * (rolling_sum(actual, window) / rolling_sum(expected, window) - 1)
+
+        if combine:
+            return pd.Series(change, index=self.dates, name="change")
+        return pd.DataFrame(change, index=self.dates, columns=self.columns[selection])
+
+    def change_on(self, reference, date, window=ROLLING_DAYS):
+        # Rolling actual and expected entries of every entity on one day, and their percent change
+        row = self.dates.get_loc(pd.Timestamp(date))
+        rows = slice(max(row + 1 - window, 0), row + 1)
+        actual = self.actual[rows].sum(axis=0)
+        expected = self.expected(reference)[rows].sum(axis=0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = 100 * (actual / expected - 1)
+        return pd.DataFrame({"actual": actual, "expected": expected, "change": change}, index=self.columns)
+
+    def period_change(self, reference, start, end):
+        # Percent change of each entity over the whole [start, end] period
+        rows = (self.dates >= start) & (self.dates <= end)
+        actual = self.actual[rows].sum(axis=0)
+        expected = self.expected(reference)[rows].sum(axis=0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return pd.Series(100 * (actual / expected - 1), index=self.columns, name="change")
@@ -0,0 +1,156 @@
+import os
+import threading
+
+import pandas as pd
+
+from bridge.baseline import ChangeEngine
+from bridge.filters import DimensionIndex
+from bridge.intraday import INDEX_FILE, INTRADAY_DIR, IntradayStore
+from bridge.rollups import Rollups
+from bridge.sampling import StratifiedSample
+from bridge.search import SearchIndex
+from bridge.spatial import SpatialBins
+from bridge.versioning import DataVersionManager
+
+
+################################################
+################################################
+
+# Data loading functions, shared by the pages and the API
+
+# Data is loaded once per process by version managers, which reload it in the background
+# when the source files change so new data is picked up without restarting the server
+
+CHART_DATA_PATH = 'input/clean_data.csv'
+STATION_PIVOT_PATH = 'input/station_entry_pivot.csv'
+NTA_DATA_PATH = 'output/nta_fulldata_d.csv'
+INTRADAY_INDEX_PATH = os.path.join(INTRADAY_DIR, INDEX_FILE)
+
+date_format = "%Y-%m-%d"
+
+
+# CHARTS
+def load_chart_data():
+    # Load the data
+    data = pd.read_csv(CHART_DATA_PATH, low_memory=False)
+    data['date'] = pd.to_datetime(data['date'], format = date_format)
+    data = data[['stop_name', 'date', 'entries', 'line', 'borough', 'daytime_routes', 'division',
+        'structure', 'gtfs_longitude', 'gtfs_latitude']]
+
+    return data
+
+# Everything derived from the data is built with it, off the rerun path
+def build_chart_snapshot():
+    data = load_chart_data()
+
+    # Tag each row with its station id in the filter index
+    filter_index = DimensionIndex(data)
+    data['station_id'] = filter_index.row_codes
+
+    # Daily, weekly and monthly rollups for the time series chart
+    rollups = Rollups(data)
+
+    # Stratified samples for the approximate preview: raw rows, and station-day points
+    row_sample = StratifiedSample(data, ['borough', 'station_id'])
+    station_days = data.groupby(['stop_name', 'date', 'borough'], as_index=False)['entries'].sum()
+    point_sample = StratifiedSample(station_days, ['borough', 'stop_name'])
+
+    # Baseline and percent change of every station id
+    changes = ChangeEngine(rollups.frames["Daily"].pivot(index="date", columns="station_id", values="entries"))
+
+    # Stop name search, over the same values as the filter index, busiest stations first
+    stop_names = filter_index.values['stop_name']
+    stop_search = SearchIndex(stop_names, data.groupby('stop_name')['entries'].sum().reindex(stop_names))
+
+    return data, filter_index, rollups, row_sample, point_sample, changes, stop_search
+
+
+# DYN MAP
+def load_station_data():
+    # coordinates for each station
+    data = pd.read_csv(CHART_DATA_PATH, low_memory=False)
+    coords = data[["gtfs_latitude", "gtfs_longitude", "stop_name"]]
+
+    # pivot table showing daily entries for each station
+    counts_df = pd.read_csv(STATION_PIVOT_PATH, parse_dates=['date'],
+                            index_col="date")
+
+
+    return data, coords, counts_df
+
+# Station grid totals are built with the data, off the rerun path
+def build_station_snapshot():
+    data, coords, counts_df = load_station_data()
+
+    # One row per station location (the data has one per station-day)
+    coords = coords.drop_duplicates().reset_index(drop=True)
+    spatial_bins = SpatialBins(coords, counts_df)
+
+    # Baseline and percent change of every station name
+    changes = ChangeEngine(counts_df)
+
+    return data, coords, counts_df, spatial_bins, changes
+
+
+# CHORO MAP
+def load_map_data_daily():
+    map_data = pd.read_csv(NTA_DATA_PATH)
+    map_data['date'] = pd.to_datetime(map_data['date'], format = date_format)
+
+    return map_data
+
+# Baseline and percent change of every NTA, and the NTA name search, are built with the data
+def build_nta_snapshot():
+    map_data = load_map_data_daily()
+    changes = ChangeEngine(map_data.pivot_table(index="date", columns="NTACode", values="entries", aggfunc="sum"))
+
+    # One row per NTA name with its borough, busiest NTAs first in the search
+    nta_names = map_data.groupby("NTAName").agg(borough=("borough", "first"), entries=("entries", "sum"))
+    nta_search = SearchIndex(nta_names.index, nta_names["entries"])
+
+    return map_data, changes, nta_names, nta_search
+
+
+# INTRA-DAY
+# Memory-mapped, so a new version only costs its index; None until built (python -m bridge.intraday)
+def build_intraday_snapshot():
+    if not os.path.exists(INTRADAY_INDEX_PATH):
+        return None
+    return IntradayStore(INTRADAY_DIR)
+
+
+################################################
+################################################
+
+# Process-wide version managers
+
+_managers = {}
+_managers_lock = threading.Lock()
+_build_locks = {}
+
+def _versions(name, paths, loader):
+    # Loaded managers are returned without locking; a new one is built under its own lock,
+    # so a first load does not hold up the pages and requests using the other managers
+    manager = _managers.get(name)
+    if manager is not None:
+        return manager
+
+    with _managers_lock:
+        build_lock = _build_locks.setdefault(name, threading.Lock())
+    with build_lock:
+        if name not in _managers:
+            _managers[name] = DataVersionManager(paths, loader)
+        return _managers[name]
+
+def chart_versions():
+    return _versions("chart", [CHART_DATA_PATH], build_chart_snapshot)
+
+def station_versions():
+    return _versions("station", [CHART_DATA_PATH, STATION_PIVOT_PATH], build_station_snapshot)
+
+def nta_versions():
+    return _versions("nta", [NTA_DATA_PATH], build_nta_snapshot)
+
+def intraday_versions():
+    # The index is written last by every build, watching it is enough
+    return _versions("intraday", [INTRADAY_INDEX_PATH], build_intraday_snapshot)
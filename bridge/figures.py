@@ -0,0 +1,119 @@
+import base64
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Plotly figure skeletons
+#
+# The layout and trace styling of each view is built once per process through the usual
+# px/go calls, then every rerun only swaps its data arrays into a copy of that skeleton.
+# Numeric and date arrays are sent as base64 typed arrays instead of JSON lists.
+
+# Trace attributes holding data, removed from the skeletons
+DATA_KEYS = ["x", "y", "z", "ids", "labels", "parents", "values", "locations",
+             "customdata", "text", "hovertext"]
+
+# Smallest typed array kinds understood by plotly.js, by value range
+INTEGER_TYPES = [("i1", np.int8), ("u1", np.uint8), ("i2", np.int16), ("u2", np.uint16),
+                 ("i4", np.int32), ("u4", np.uint32)]
+
+
+def encode_array(values):
+    # Typed array dict ({"dtype", "bdata"}) for numeric and date arrays, plain list otherwise.
+    # Dates become milliseconds since epoch, which plotly reads on axes of type "date".
+    values = np.asarray(values)
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+    elif values.dtype == bool:
+        values = values.astype(np.uint8)
+    elif not np.issubdtype(values.dtype, np.number):
+        return values.tolist()
+
+    # 2D arrays (heatmaps) are sent flat with their shape
+    shape = {"shape": ", ".join(map(str, values.shape))} if values.ndim > 1 else {}
+
+    if np.issubdtype(values.dtype, np.integer):
+        lo, hi = (values.min(), values.max()) if values.size else (0, 0)
+        for code, dtype in INTEGER_TYPES:
+            if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+                return {"dtype": code, "bdata": base64.b64encode(values.astype(dtype).tobytes()).decode(), **shape}
+        values = values.astype(np.float64)
+
+    # Large magnitudes (dates, big totals) keep double precision
+    code, dtype = ("f8", "<f8") if values.size and np.nanmax(np.abs(values)) > 1e7 else ("f4", "<f4")
+    return {"dtype": code, "bdata": base64.b64encode(values.astype(dtype).tobytes()).decode(), **shape}
+
+
+def _strip(trace):
+    trace = {key: value for key, value in trace.items() if key not in DATA_KEYS}
+    for key in ["error_y", "error_x"]:
+        if key in trace:
+            trace[key] = {k: v for k, v in trace[key].items() if k != "array"}
+    return trace
+
+
+def _set(trace, path, value):
+    # Set a possibly nested attribute ("error_y.array"), copying the nested dicts on the way
+    keys = path.split(".")
+    for key in keys[:-1]:
+        trace[key] = dict(trace.get(key, {}))
+        trace = trace[key]
+    if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+        value = encode_array(value)
+    trace[keys[-1]] = value
+
+
+class FigureSkeletons:
+    # Static part of each figure, by key (view name and anything changing its layout)
+
+    def __init__(self):
+        self._skeletons = {}
+        self._lock = threading.Lock()
+
+    def skeleton(self, key, build):
+        with self._lock:
+            if key not in self._skeletons:
+                figure = build().to_dict()
+                self._skeletons[key] = {"data": [_strip(trace) for trace in figure["data"]],
+                                        "layout": figure["layout"]}
+            return self._skeletons[key]
+
+    def figure(self, key, build, traces, layout=None):
+        # Copy of the skeleton with the data of each trace (dicts of attribute -> values);
+        # skeleton traces without data (None, or past the end of `traces`) are left out
+        skeleton = self.skeleton(key, build)
+
+        data = []
+        for trace, values in zip(skeleton["data"], traces):
+            if values is None:
+                continue
+            trace = dict(trace)
+            for path, value in values.items():
+                _set(trace, path, value)
+            data.append(trace)
+
+        figure = go.Figure({"data": data, "layout": skeleton["layout"]}, _validate=False)
+        if layout:
+            figure.update_layout(layout)
+        return figure
+
+
+def figure_size(figure):
+    # Size in bytes of the JSON sent to the browser
+    return len(pio.to_json(figure, validate=False))
+
+def log_figure_size(view, figure):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s figure: %d bytes", view, figure_size(figure))
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+
+################################################
+################################################
+
+# Cascading filter index
+
+# Filter columns, from the most upstream (Borough) to the most downstream (Stop Name)
+FILTER_COLUMNS = ["borough", "division", "line", "stop_name"]
+
+
+class DimensionIndex:
+    # Station-level hierarchy table: one row per distinct (borough, division, line, stop_name)
+    # combination, each column stored as integer codes into its sorted list of values.
+    # Filter options and row selections are answered from this small table, the fact table
+    # is only read once when the index is built.
+
+    def __init__(self, data, columns=FILTER_COLUMNS):
+        self.columns = list(columns)
+
+        keys = data[self.columns]
+        grouper = keys.groupby(self.columns, dropna=False, sort=True)
+
+        # Station id of every row of the fact table
+        self.row_codes = grouper.ngroup().to_numpy()
+
+        self.stations = grouper.size().reset_index()[self.columns]
+        self.n_stations = len(self.stations)
+
+        self.values = {}
+        self.codes = {}
+        self.positions = {}
+        for col in self.columns:
+            categorical = pd.Categorical(self.stations[col])
+            self.values[col] = list(categorical.categories)
+            # Missing values (-1) are sent to an extra slot that is never selected
+            codes = categorical.codes.astype(np.int64)
+            codes[codes < 0] = len(self.values[col])
+            self.codes[col] = codes
+            self.positions[col] = {value: i for i, value in enumerate(self.values[col])}
+
+    def station_mask(self, selections, rows=None):
+        # Boolean mask over stations matching every non-empty selection, and with at least one
+        # row in the `rows` boolean mask over the indexed frame if given (e.g. a date range)
+        mask = np.ones(self.n_stations, dtype=bool)
+        if rows is not None:
+            mask &= np.bincount(self.row_codes[rows], minlength=self.n_stations) > 0
+        for col in self.columns:
+            selected = selections.get(col)
+            if not selected:
+                continue
+            lookup = np.zeros(len(self.values[col]) + 1, dtype=bool)
+            lookup[[self.positions[col][v] for v in selected if v in self.positions[col]]] = True
+            mask &= lookup[self.codes[col]]
+        return mask
+
+    def option_mask(self, column, selections, rows=None):
+        # Boolean mask over the values of `column` still reachable given the selections made upstream of it
+        upstream = self.columns[:self.columns.index(column)]
+        mask = self.station_mask({col: selections.get(col) for col in upstream}, rows)
+        present = np.bincount(self.codes[column][mask], minlength=len(self.values[column]) + 1)
+        return present[:-1] > 0
+
+    def options(self, column, selections, rows=None):
+        # Sorted values of `column` still reachable given the selections made upstream of it
+        mask = self.option_mask(column, selections, rows)
+        return [value for value, present in zip(self.values[column], mask) if present]
+
+    def row_mask(self, selections, station_ids=None):
+        # Boolean mask over fact rows, given their station ids (defaults to the indexed frame)
+        if station_ids is None:
+            station_ids = self.row_codes
+        return self.station_mask(selections)[np.asarray(station_ids)]
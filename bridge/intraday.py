@@ -0,0 +1,192 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from bridge.search import normalize
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Intra-day entries in 4-hour buckets
+#
+# Turnstile counters are audited about every 4 hours. Entries of every audit interval are
+# summed into a station x day x bucket uint32 array stored as a .npy file, which is memory-mapped
+# when loaded: opening it costs the index only, and only the pages actually read stay resident.
+# Build it from the raw MTA turnstile files with `python -m bridge.intraday`.
+
+BUCKET_HOURS = 4
+N_BUCKETS = 24 // BUCKET_HOURS
+BUCKET_LABELS = [f"{h:02d}:00-{h + BUCKET_HOURS:02d}:00" for h in range(0, 24, BUCKET_HOURS)]
+
+INTRADAY_DIR = 'output/intraday'
+INDEX_FILE = 'index.json'
+ENTRIES_FILE = 'entries.npy'
+TOTALS_FILE = 'totals.npy'
+
+# Raw MTA turnstile files (C/A, UNIT, SCP, STATION, LINENAME, DIVISION, DATE, TIME, DESC, ENTRIES, EXITS)
+TURNSTILE_PATTERN = 'input/turnstile/turnstile_*.txt'
+TURNSTILE_KEYS = ["C/A", "UNIT", "SCP", "STATION"]
+
+# Optional STATION, LINENAME -> stop_name table for the names not matching the station pivot
+STATION_MAP_PATH = 'input/turnstile_stations.csv'
+
+# Larger counter jumps within one audit interval are resets, not entries
+MAX_INTERVAL_ENTRIES = 10000
+
+
+class IntradayStore:
+    # Memory-mapped intra-day entries, with the day x bucket totals of every station in memory
+
+    def __init__(self, directory=INTRADAY_DIR):
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+
+        self.built = index["built"]
+        self.stations = pd.Index(index["stations"])
+        self.dates = pd.DatetimeIndex(index["dates"])
+        self.entries = np.load(os.path.join(directory, index["entries"]), mmap_mode="r")
+        self.totals = np.load(os.path.join(directory, index["totals"]))
+
+    def day(self, date, bucket=None):
+        # Entries of every station on one day, in one bucket or the whole day
+        day = self.dates.get_loc(pd.Timestamp(date))
+        values = self.entries[:, day].sum(axis=1) if bucket is None else self.entries[:, day, bucket]
+        return pd.Series(values, index=self.stations, name="counts")
+
+    def heatmap(self, stations=None, start=None, end=None):
+        # Bucket x day entries of the selected stations (every station if None) over [start, end]
+        rows = slice(self.dates.searchsorted(start) if start is not None else 0,
+                     self.dates.searchsorted(end, side="right") if end is not None else len(self.dates))
+
+        if stations is None:
+            values = self.totals[rows]
+        else:
+            ids = self.stations.get_indexer(stations)
+            # Sorted ids read the memory-mapped rows in file order
+            values = self.entries[np.sort(ids[ids >= 0]), rows].sum(axis=0, dtype=np.uint64)
+
+        return pd.DataFrame(values.T, index=BUCKET_LABELS, columns=self.dates[rows])
+
+
+################################################
+################################################
+
+# Build from the raw turnstile files
+
+def read_turnstile(path):
+    frame = pd.read_csv(path, usecols=lambda col: col.strip() in TURNSTILE_KEYS + ["LINENAME", "DATE", "TIME", "ENTRIES"],
+                        dtype=str)
+    frame.columns = frame.columns.str.strip()
+    frame["ENTRIES"] = pd.to_numeric(frame["ENTRIES"], errors="coerce")
+    frame["time"] = pd.to_datetime(frame["DATE"] + " " + frame["TIME"], format="%m/%d/%Y %H:%M:%S")
+    return frame.drop(columns=["DATE", "TIME"])
+
+def interval_entries(frame):
+    # Entries of each audit interval from the cumulative counter of each turnstile.
+    # An audit at time t closes the interval since the previous one, counted in the bucket of t - 1s
+    # (the 00:00 audit goes to the last bucket of the previous day).
+    frame = frame.sort_values(TURNSTILE_KEYS + ["time"]).drop_duplicates(TURNSTILE_KEYS + ["time"])
+    turnstile = frame.groupby(TURNSTILE_KEYS, sort=False).ngroup().to_numpy()
+
+    entries = np.abs(np.diff(frame["ENTRIES"].to_numpy(), prepend=np.nan))
+    valid = (turnstile == np.roll(turnstile, 1)) & (entries <= MAX_INTERVAL_ENTRIES)
+    valid[0] = False
+
+    end = frame["time"] - pd.Timedelta(seconds=1)
+    return pd.DataFrame({"STATION": frame["STATION"], "LINENAME": frame["LINENAME"],
+                         "date": end.dt.normalize(), "bucket": end.dt.hour // BUCKET_HOURS,
+                         "entries": entries})[valid]
+
+def station_names(stations, raw_names, map_path=STATION_MAP_PATH):
+    # stop_name of each (STATION, LINENAME) pair: from the mapping table, else by normalized name
+    by_name = {normalize(name): name for name in stations}
+    names = raw_names.reset_index(drop=True)
+    names["stop_name"] = names["STATION"].map(lambda name: by_name.get(normalize(name)))
+
+    if os.path.exists(map_path):
+        mapping = pd.read_csv(map_path, dtype=str).drop_duplicates(["STATION", "LINENAME"])
+        mapped = names[["STATION", "LINENAME"]].merge(mapping, on=["STATION", "LINENAME"], how="left")["stop_name"]
+        names["stop_name"] = mapped.fillna(names["stop_name"])
+    return names
+
+def build_intraday(stations, dates, pattern=TURNSTILE_PATTERN, directory=INTRADAY_DIR):
+    # Accumulate every raw file into the station x day x bucket array, one file in memory at a time.
+    # The axes are those of the station pivot so the intra-day views line up with the daily ones.
+    stations = pd.Index(stations)
+    dates = pd.DatetimeIndex(dates)
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"No turnstile files matching {pattern}")
+
+    os.makedirs(directory, exist_ok=True)
+    entries_path = os.path.join(directory, f"{ENTRIES_FILE}.{os.getpid()}.tmp")
+    entries = np.lib.format.open_memmap(entries_path, mode="w+", dtype=np.uint32,
+                                        shape=(len(stations), len(dates), N_BUCKETS))
+
+    # Last reading of each turnstile, carried over to the next file
+    last = None
+    unmatched = set()
+    for path in paths:
+        frame = read_turnstile(path)
+        if last is not None:
+            frame = pd.concat([last, frame])
+        last = frame.sort_values("time").groupby(TURNSTILE_KEYS, sort=False).tail(1)
+
+        intervals = interval_entries(frame)
+        names = station_names(stations, intervals[["STATION", "LINENAME"]].drop_duplicates())
+        intervals = intervals.merge(names, on=["STATION", "LINENAME"], how="left")
+        unmatched.update(intervals.loc[intervals["stop_name"].isna(), "STATION"])
+
+        station_ids = stations.get_indexer(intervals["stop_name"])
+        day_ids = dates.get_indexer(intervals["date"])
+        keep = (station_ids >= 0) & (day_ids >= 0)
+        np.add.at(entries, (station_ids[keep], day_ids[keep], intervals["bucket"].to_numpy()[keep]),
+                  intervals["entries"].to_numpy()[keep].astype(np.uint32))
+        logger.info("Added %s (%d intervals)", path, keep.sum())
+
+    if unmatched:
+        logger.warning("%d turnstile stations without a stop name (add them to %s): %s",
+                       len(unmatched), STATION_MAP_PATH, ", ".join(sorted(unmatched)[:20]))
+
+    totals = entries.sum(axis=0, dtype=np.uint64)
+    entries.flush()
+    del entries
+
+    # Data files first, the index last: a store opened meanwhile keeps its own (replaced) files
+    os.replace(entries_path, os.path.join(directory, ENTRIES_FILE))
+    tmp_path = os.path.join(directory, f"{TOTALS_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, totals)
+    os.replace(tmp_path, os.path.join(directory, TOTALS_FILE))
+
+    index = {"built": time.strftime("%Y-%m-%dT%H:%M:%S"), "entries": ENTRIES_FILE, "totals": TOTALS_FILE,
+             "stations": stations.tolist(), "dates": [f"{d:%Y-%m-%d}" for d in dates]}
+    tmp_path = os.path.join(directory, f"{INDEX_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(directory, INDEX_FILE))
+    return index
+
+
+if __name__ == "__main__":
+    from bridge.data import STATION_PIVOT_PATH
+
+    parser = argparse.ArgumentParser(description="Build the intra-day entries from the raw MTA turnstile files")
+    parser.add_argument("--pattern", default=TURNSTILE_PATTERN)
+    parser.add_argument("--directory", default=INTRADAY_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pivot = pd.read_csv(STATION_PIVOT_PATH, parse_dates=['date'], index_col="date")
+    index = build_intraday(pivot.columns, pivot.index, args.pattern, args.directory)
+    logger.info("Built %d stations x %d days x %d buckets", len(index["stations"]), len(index["dates"]), N_BUCKETS)
@@ -0,0 +1,299 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from bridge.aggregates import station_counts, station_day_counts
+from bridge.baseline import default_reference
+from bridge.data import CHART_DATA_PATH, STATION_PIVOT_PATH, build_station_snapshot
+from bridge.spatial import CELL_SIZES, change_colors, column_colors
+from bridge.versioning import content_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Dynamic Map frames
+#
+# A frame is the layer data of one day (column positions, counts and colors) for one styling.
+# Frames are stored by a hash of the data version, the date and the styling, so they can be
+# pre-built for the whole dataset by `python -m bridge.prerender` and served to every viewer.
+# Each data version has its own directory, the pre-render removes those of older versions.
+
+FRAME_DIR = 'output/frames'
+
+# Frames kept in memory by each process, and views built from them (e.g. serialized map decks)
+MEMORY_FRAMES = 512
+MEMORY_VIEWS = 128
+
+STATION_PATHS = [CHART_DATA_PATH, STATION_PIVOT_PATH]
+
+
+def frame_style(mode="Stations", cell_size=None, color_by="Entries", reference=None, bucket=None):
+    # Normalized styling parameters of a frame. Intra-day frames (one 4-hour bucket) are colored
+    # by entries, and only they carry a bucket so the keys of the daily frames stay the same.
+    if bucket is not None:
+        color_by = "Entries"
+    style = {
+        "mode": mode,
+        "cell_size": int(cell_size) if mode == "Grid" else None,
+        "color_by": color_by,
+        "reference": [f"{pd.Timestamp(d):%Y-%m-%d}" for d in reference] if color_by != "Entries" else None,
+    }
+    if bucket is not None:
+        style["bucket"] = int(bucket)
+    return style
+
+def frame_key(version, date, style):
+    payload = json.dumps({"version": version, "date": f"{pd.Timestamp(date):%Y-%m-%d}", **style}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+def build_frame(data, date, style, intraday=None):
+    # Layer data of one day, from a station snapshot (see bridge.data.build_station_snapshot),
+    # and the intra-day store for the frames of one bucket
+    _, coords, counts_df, spatial_bins, changes = data
+    date = pd.Timestamp(date)
+    by_change = style["color_by"] != "Entries"
+    reference = tuple(pd.to_datetime(style["reference"])) if by_change else None
+    counts = intraday.day(date, style["bucket"]) if "bucket" in style else None
+
+    if style["mode"] == "Grid":
+        # Pre-aggregated bins, colored in SpatialBins
+        station_change = changes.change_on(reference, date) if by_change else None
+        frame = spatial_bins.frame(style["cell_size"], date, station_change, counts)
+    else:
+        if counts is None:
+            frame, max_entry = station_day_counts(coords, counts_df, date)
+        else:
+            frame, max_entry = station_counts(coords, counts)
+        if by_change:
+            frame["change"] = frame["stop_name"].map(changes.change_on(reference, date)["change"])
+            frame["color"] = change_colors(frame["change"].to_numpy()).tolist()
+        else:
+            frame["color"] = column_colors(frame["counts"].to_numpy(), max_entry).tolist()
+
+    return frame[["gtfs_longitude", "gtfs_latitude", "counts", "color"]]
+
+
+class FrameStore:
+    # Frames on disk (one .npz per key under the data version, written atomically) with an
+    # in-memory LRU in front, and a second LRU of the views built from them
+
+    def __init__(self, directory=FRAME_DIR, memory_frames=MEMORY_FRAMES, memory_views=MEMORY_VIEWS):
+        self.directory = directory
+        self.memory_frames = memory_frames
+        self.memory_views = memory_views
+        self._memory = OrderedDict()
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, version, key):
+        return os.path.join(self.directory, version, key[:2], f"{key}.npz")
+
+    def load(self, version, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        path = self.path(version, key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            frame = pd.DataFrame({"gtfs_longitude": arrays["longitude"], "gtfs_latitude": arrays["latitude"],
+                                  "counts": arrays["counts"], "color": arrays["color"].tolist()})
+        self._remember(key, frame)
+        return frame
+
+    def save(self, version, key, frame):
+        path = self.path(version, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, longitude=frame["gtfs_longitude"].to_numpy(),
+                                latitude=frame["gtfs_latitude"].to_numpy(),
+                                counts=frame["counts"].to_numpy(dtype=np.float32),
+                                color=np.array(frame["color"].tolist(), dtype=np.uint8).reshape(-1, 4))
+        os.replace(tmp_path, path)
+        self._remember(key, frame)
+
+    def get(self, data, version, date, style, intraday=None, persist=True):
+        # Stored frame, or built and stored on a miss. The version covers the intra-day data if used.
+        # Frames of one viewer's styling (persist=False, e.g. a custom baseline period) are only
+        # kept in memory.
+        key = frame_key(version, date, style)
+        frame = self.load(version, key)
+        if frame is None:
+            frame = build_frame(data, date, style, intraday)
+            if not persist:
+                self._remember(key, frame)
+                return frame
+            try:
+                self.save(version, key, frame)
+            except OSError:
+                logger.warning("Could not store frame %s", key)
+        return frame
+
+    def view(self, data, version, date, style, settings, build, intraday=None, persist=True):
+        # build(frame) once per frame and view settings (e.g. the zoom), shared by every rerun and viewer
+        key = (frame_key(version, date, style), settings)
+        with self._lock:
+            if key in self._views:
+                self._views.move_to_end(key)
+                return self._views[key]
+
+        view = build(self.get(data, version, date, style, intraday, persist))
+        with self._lock:
+            self._views[key] = view
+            self._views.move_to_end(key)
+            while len(self._views) > self.memory_views:
+                self._views.popitem(last=False)
+        return view
+
+    def _remember(self, key, frame):
+        with self._lock:
+            self._memory[key] = frame
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_frames:
+                self._memory.popitem(last=False)
+
+
+################################################
+################################################
+
+# Batch pre-rendering
+
+_worker_data = None
+
+def _init_worker(data):
+    # Workers are forked with the parent's snapshot, so frames match the version they are stored under
+    global _worker_data
+    _worker_data = data
+
+def _render_dates(args):
+    version, dates, styles, directory = args
+    store = FrameStore(directory, memory_frames=0)
+    built = 0
+    for date in dates:
+        for style in styles:
+            key = frame_key(version, date, style)
+            if not os.path.exists(store.path(version, key)):
+                store.save(version, key, build_frame(_worker_data, date, style))
+                built += 1
+    return built
+
+def default_styles(dates, cell_sizes=CELL_SIZES):
+    # Every styling offered by the page, with the default baseline period
+    reference = default_reference(dates)
+    styles = []
+    for color_by in ["Entries", "Change vs baseline"]:
+        styles.append(frame_style("Stations", color_by=color_by, reference=reference))
+        styles += [frame_style("Grid", cell_size, color_by, reference) for cell_size in cell_sizes]
+    return styles
+
+def remove_old_versions(version, directory=FRAME_DIR):
+    # Frame directories of other data versions (intra-day frames use "<version>.<intra-day version>")
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name != version and not name.startswith(f"{version}."):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+            logger.info("Removed the frames of data version %s", name)
+
+def load_station_snapshot(paths=STATION_PATHS):
+    # Station snapshot with the version of the files it was loaded from, hashed before and after
+    # the load: loaded again if the files changed meanwhile
+    while True:
+        version = content_hash(paths)
+        data = build_station_snapshot()
+        if content_hash(paths) == version:
+            return version, data
+        logger.info("Station data changed while loading, loading it again")
+
+def prerender(styles=None, workers=None, directory=FRAME_DIR, chunk_days=7):
+    # Build the missing frames of every date of the dataset, spread over a process pool by chunks of dates
+    version, data = load_station_snapshot()
+    dates = pd.DatetimeIndex(data[2].index)
+    styles = styles or default_styles(dates)
+    remove_old_versions(version, directory)
+
+    # Forked workers inherit the snapshot as is (it holds locks, so it is not pickled)
+    chunks = [(version, dates[i:i + chunk_days], styles, directory) for i in range(0, len(dates), chunk_days)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=_init_worker, initargs=(data,)) as pool:
+        built = sum(pool.map(_render_dates, chunks))
+
+    logger.info("Built %d frames (%d dates x %d styles) for data version %s",
+                built, len(dates), len(styles), version)
+    return version, dates, styles
+
+
+################################################
+################################################
+
+# Time-lapse export
+
+def export_timelapse(path, version, dates, style, directory=FRAME_DIR, size=800, day_ms=150):
+    # Animated GIF of stored frames: one disk per column, area proportional to the counts
+    store = FrameStore(directory, memory_frames=0)
+    frames = [(date, store.load(version, frame_key(version, date, style))) for date in dates]
+    frames = [(date, frame) for date, frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        raise ValueError("No stored frames for this style, run the pre-render first")
+
+    # Same projection and scale for every day
+    every = pd.concat([frame for date, frame in frames])
+    lon_min, lon_max = every["gtfs_longitude"].min(), every["gtfs_longitude"].max()
+    lat_min, lat_max = every["gtfs_latitude"].min(), every["gtfs_latitude"].max()
+    lon_scale = np.cos(np.radians((lat_min + lat_max) / 2))
+    scale = (size - 40) / max((lon_max - lon_min) * lon_scale, lat_max - lat_min)
+    max_counts = every["counts"].max()
+
+    images = []
+    for date, frame in frames:
+        image = Image.new("RGB", (size, size), (30, 19, 63))
+        draw = ImageDraw.Draw(image)
+        x = 20 + (frame["gtfs_longitude"].to_numpy() - lon_min) * lon_scale * scale
+        y = size - 20 - (frame["gtfs_latitude"].to_numpy() - lat_min) * scale
+        radius = 1 + 12 * np.sqrt(frame["counts"].to_numpy() / max_counts)
+        for xi, yi, ri, color in zip(x, y, radius, frame["color"]):
+            draw.ellipse([xi - ri, yi - ri, xi + ri, yi + ri], fill=tuple(color[:3]))
+        draw.text((20, 20), f"{date:%Y-%m-%d}", fill=(255, 255, 255))
+        images.append(image)
+
+    images[0].save(path, save_all=True, append_images=images[1:], duration=day_ms, loop=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render the Dynamic Map frames of the whole dataset")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: CPU count)")
+    parser.add_argument("--directory", default=FRAME_DIR)
+    parser.add_argument("--timelapse", default=None, help="Also export a time-lapse GIF to this path")
+    parser.add_argument("--timelapse-cell-size", type=int, default=1000,
+                        help="Grid cell size of the time-lapse, 0 for stations")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    version, dates, styles = prerender(workers=args.workers, directory=args.directory)
+
+    if args.timelapse:
+        mode = "Grid" if args.timelapse_cell_size else "Stations"
+        style = frame_style(mode, args.timelapse_cell_size)
+        if style not in styles:
+            raise SystemExit(f"No pre-rendered frames for {style}")
+        export_timelapse(args.timelapse, version, dates, style, args.directory)
+        logger.info("Exported the time-lapse to %s", args.timelapse)
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+
+################################################
+################################################
+
+# Temporal rollups
+
+# Resolutions from the finest to the coarsest, with the pandas period each one aggregates to
+RESOLUTIONS = {"Daily": "D", "Weekly": "W", "Monthly": "M"}
+
+# Unit shown in chart titles for each resolution
+RESOLUTION_UNITS = {"Daily": "day", "Weekly": "week", "Monthly": "month"}
+
+# Maximum number of points a time series chart should draw
+POINT_BUDGET = 400
+
+
+class Rollups:
+    # Entries summed per station and per day, week and month, built once per data version.
+    # Each rollup is sorted by date so a date range is two binary searches, and the totals over
+    # all stations are precomputed so the unfiltered series never touches the station rows.
+
+    def __init__(self, data, key="station_id", value="entries"):
+        self.key = key
+
+        daily = data.groupby([key, "date"], as_index=False).agg(entries=(value, "sum"),
+                                                                rows=(value, "size"))
+
+        self.start = daily["date"].min()
+        self.end = daily["date"].max()
+
+        self.frames = {}
+        self.totals = {}
+        for resolution, freq in RESOLUTIONS.items():
+            if freq == "D":
+                frame = daily
+            else:
+                # Coarser rollups are aggregated from the daily one, labelled by period start
+                period = daily["date"].dt.to_period(freq).dt.start_time.rename("date")
+                frame = daily.groupby([daily[key], period], as_index=False)[["entries", "rows"]].sum()
+
+            frame = frame.sort_values(["date", key], kind="stable").reset_index(drop=True)
+            self.frames[resolution] = frame
+            self.totals[resolution] = frame.groupby("date")["entries"].sum()
+
+    def period_start(self, resolution, date):
+        return pd.Timestamp(date).to_period(RESOLUTIONS[resolution]).start_time
+
+    def n_points(self, resolution, start, end):
+        return len(pd.period_range(start, end, freq=RESOLUTIONS[resolution]))
+
+    def pick_resolution(self, start, end, budget=POINT_BUDGET):
+        # Finest resolution whose number of points over the range fits the budget
+        for resolution in RESOLUTIONS:
+            if self.n_points(resolution, start, end) <= budget:
+                return resolution
+        return resolution
+
+    def series(self, resolution, start, end, station_mask=None):
+        # Entries per period over [start, end]. Whole periods come from the rollup, the partial
+        # first and last ones are summed from the daily rollup over the days in the range and
+        # labelled by their first day in it, so no entries (or labels) fall outside the range.
+        # station_mask is a boolean array over station ids, None means all stations.
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if resolution == "Daily":
+            return self._sums("Daily", start, end, station_mask)
+
+        day = pd.Timedelta(days=1)
+        # Whole periods start in [whole_start, whole_end)
+        whole_start = self.period_start(resolution, start)
+        if whole_start < start:
+            whole_start = self.next_period_start(resolution, start)
+        whole_end = self.period_start(resolution, end + day)
+
+        parts = []
+        if start < whole_start:
+            parts.append(self._clipped(start, min(whole_start - day, end), station_mask))
+        if whole_start < whole_end:
+            parts.append(self._sums(resolution, whole_start, whole_end - day, station_mask))
+        if max(whole_start, whole_end) <= end:
+            parts.append(self._clipped(max(whole_start, whole_end), end, station_mask))
+
+        return pd.concat(parts) if parts else self._sums(resolution, start, start - day, station_mask)
+
+    def next_period_start(self, resolution, date):
+        return (pd.Timestamp(date).to_period(RESOLUTIONS[resolution]) + 1).start_time
+
+    def _sums(self, resolution, start, end, station_mask):
+        # Entries per label of a rollup, for labels in [start, end]
+        if station_mask is None:
+            totals = self.totals[resolution]
+            return totals[(totals.index >= start) & (totals.index <= end)]
+
+        frame = self.frames[resolution]
+        dates = frame["date"].to_numpy()
+        lo = np.searchsorted(dates, start.to_datetime64(), side="left")
+        hi = np.searchsorted(dates, end.to_datetime64(), side="right")
+        frame = frame.iloc[lo:hi]
+        frame = frame[station_mask[frame[self.key].to_numpy()]]
+
+        return frame.groupby("date")["entries"].sum()
+
+    def _clipped(self, start, end, station_mask):
+        # Entries of the days in [start, end] as one point labelled `start` (none without data)
+        daily = self._sums("Daily", start, end, station_mask)
+        if daily.empty:
+            return daily
+        return pd.Series([daily.sum()], index=pd.DatetimeIndex([start], name="date"), name="entries")
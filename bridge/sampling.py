@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+
+################################################
+################################################
+
+# Stratified sampling for the approximate preview mode
+
+# Share of the rows kept in each stratum, and minimum number of rows kept per stratum
+SAMPLE_RATE = 0.05
+MIN_ROWS = 5
+
+# Multiplier of the standard error shown as error bars (95% interval)
+Z_95 = 1.96
+
+
+class StratifiedSample:
+    # Sample drawn independently in each stratum (e.g. borough and station) and spread over its
+    # dates, built once per data version. Totals and means over any subset of rows are estimated from it with
+    # the usual stratified estimators, along with their standard errors.
+
+    def __init__(self, frame, strata, value="entries", rate=SAMPLE_RATE, min_rows=MIN_ROWS, seed=0):
+        self.value = value
+        self.rate = rate
+        self.n_population = len(frame)
+
+        stratum = frame.groupby(list(strata), dropna=False, sort=False).ngroup().to_numpy()
+        population = np.bincount(stratum)
+        sizes = np.minimum(population, np.maximum(min_rows, np.ceil(rate * population).astype(int)))
+
+        # Each stratum is also stratified by date: its rows in date order are cut into `size`
+        # blocks of population / size rows, from a random offset, and one row is kept per block.
+        # Any date range then holds about `rate` of the rows of every stratum.
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((frame["date"].to_numpy(), stratum))
+        starts = np.cumsum(population) - population
+        position = np.empty(len(frame), dtype=np.int64)
+        position[order] = np.arange(len(frame)) - starts[stratum[order]]
+        step = (sizes / population)[stratum]
+        offset = rng.random(len(population))[stratum]
+        keep = np.floor((position + 1) * step + offset) > np.floor(position * step + offset)
+
+        # Rows sorted by date so a date range is two binary searches
+        rows = frame[keep].assign(_stratum=stratum[keep],
+                                  _weight=population[stratum[keep]] / sizes[stratum[keep]])
+        self.rows = rows.sort_values("date", kind="stable").reset_index(drop=True)
+
+        self.population = population
+        self.sizes = sizes
+        # Rows of the longest date block: a shorter date range misses some strata entirely
+        self.block_rows = int(np.ceil((population / sizes).max()))
+        # Per-stratum factor of the variance of a total: N² (1 - n/N) / n
+        self.variance_factor = population ** 2 * (1 - sizes / population) / sizes
+
+    def between(self, start, end):
+        # Sampled rows in the date range, with their stratum and weight
+        dates = self.rows["date"].to_numpy()
+        lo = np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), side="left")
+        hi = np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), side="right")
+        return self.rows.iloc[lo:hi]
+
+    def _total_variance(self, rows, by, z):
+        # Variance of the estimated total of z per group, z being zero outside the domain. With one
+        # row per date block, the spread of a stratum comes from the differences between successive
+        # rows (sorted by date), counting the zeros just before and after the domain.
+        frame = pd.DataFrame({"group": rows[by].to_numpy(), "stratum": rows["_stratum"].to_numpy(), "z": z})
+        frame = frame.sort_values(["group", "stratum"], kind="stable")
+        steps = frame.groupby(["group", "stratum"], sort=False)["z"]
+        differences = (steps.diff() ** 2).groupby([frame["group"], frame["stratum"]]).sum()
+        squares = differences + (steps.first() ** 2 + steps.last() ** 2) / 3
+
+        n = self.sizes[squares.index.get_level_values("stratum")]
+        spread = squares / (2 * np.maximum(n - 1, 1))
+        variance = self.variance_factor[squares.index.get_level_values("stratum")] * spread
+        return variance.groupby(level="group").sum()
+
+    def estimate(self, by, start, end, kind="mean"):
+        # Estimated mean (or total) of the value per group of `by`, with standard errors
+        rows = self.between(start, end)
+        y = rows[self.value].to_numpy(dtype=float)
+        w = rows["_weight"].to_numpy()
+
+        grouped = pd.DataFrame({by: rows[by].to_numpy(), "total": w * y, "count": w}).groupby(by)
+        estimates = grouped[["total", "count"]].sum()
+
+        if kind == "total":
+            estimates["estimate"] = estimates["total"]
+            variance = self._total_variance(rows, by, y)
+        else:
+            # Ratio estimator of the mean, variance by linearization
+            estimates["estimate"] = estimates["total"] / estimates["count"]
+            ratio = estimates["estimate"].reindex(rows[by]).to_numpy()
+            count = estimates["count"].reindex(rows[by]).to_numpy()
+            variance = self._total_variance(rows, by, (y - ratio) / count)
+
+        estimates["stderr"] = np.sqrt(variance.reindex(estimates.index).fillna(0).clip(lower=0))
+        return estimates[["estimate", "stderr"]].reset_index()
@@ -0,0 +1,100 @@
+import bisect
+import re
+import unicodedata
+
+import numpy as np
+
+
+################################################
+################################################
+
+# Name search for the Stop Name and Exclude selectors
+
+# Number of matches sent to the browser
+SEARCH_LIMIT = 12
+
+# Share of the query trigrams a name must contain to match when no prefix does, for queries of
+# at least TRIGRAM_MIN_LENGTH characters (shorter ones share trigrams with too many names)
+TRIGRAM_THRESHOLD = 0.5
+TRIGRAM_MIN_LENGTH = 4
+
+
+def normalize(text):
+    # Lowercase, without accents, words separated by single spaces ("Av-Washington  Hts" -> "av washington hts")
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    # Prefix and trigram index over a list of names, built once per data version.
+    # Prefixes are matched against every word start through a sorted list of name suffixes,
+    # misspellings and inner substrings fall back to the share of common trigrams when no prefix matches.
+    # Ties are broken by a score (e.g. total entries) so the busiest matches come first.
+
+    def __init__(self, names, scores=None):
+        self.names = list(names)
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self.scores = np.zeros(len(self.names)) if scores is None else np.nan_to_num(np.asarray(scores, dtype=float))
+        self.normalized = [normalize(name) for name in self.names]
+
+        # Suffix of each name starting at each word, sorted for binary search
+        suffixes = []
+        for i, name in enumerate(self.normalized):
+            for match in re.finditer(r"\b", name):
+                if match.start() < len(name) and name[match.start()] != " ":
+                    suffixes.append((name[match.start():], i))
+        suffixes.sort()
+        self._suffixes = [suffix for suffix, i in suffixes]
+        self._suffix_ids = np.array([i for suffix, i in suffixes], dtype=np.int64)
+
+        # Posting list of every trigram
+        postings = {}
+        for i, name in enumerate(self.normalized):
+            for gram in trigrams(name):
+                postings.setdefault(gram, []).append(i)
+        self._postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+        # Names by decreasing score, for empty queries
+        self._by_score = np.lexsort((np.arange(len(self.names)), -self.scores))
+
+    def mask(self, names):
+        # Boolean mask over the indexed names
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[[self.positions[name] for name in names if name in self.positions]] = True
+        return mask
+
+    def search(self, query, limit=SEARCH_LIMIT, allowed=None):
+        # Best `limit` names for the query, restricted to the `allowed` boolean mask if given
+        query = normalize(query)
+        if allowed is None:
+            allowed = np.ones(len(self.names), dtype=bool)
+
+        if not query:
+            return [self.names[i] for i in self._by_score[allowed[self._by_score]][:limit]]
+
+        # Tier 0: the name starts with the query, tier 1: one of its words does, tier 2: trigrams only
+        tier = np.full(len(self.names), 3)
+        similarity = np.zeros(len(self.names))
+
+        lo = bisect.bisect_left(self._suffixes, query)
+        hi = bisect.bisect_left(self._suffixes, query + "\x7f")
+        word_matches = self._suffix_ids[lo:hi]
+        tier[word_matches] = 1
+        tier[[i for i in word_matches if self.normalized[i].startswith(query)]] = 0
+
+        # Trigrams only when no allowed name matches a prefix (misspellings, inner substrings)
+        prefix_found = allowed[word_matches].any()
+        grams = trigrams(query)
+        hits = [self._postings[gram] for gram in grams if gram in self._postings]
+        if hits and not prefix_found and len(query) >= TRIGRAM_MIN_LENGTH:
+            similarity = np.bincount(np.concatenate(hits), minlength=len(self.names)) / len(grams)
+            tier[(tier == 3) & (similarity >= TRIGRAM_THRESHOLD)] = 2
+
+        candidates = np.nonzero((tier < 3) & allowed)[0]
+        order = np.lexsort((candidates, -self.scores[candidates], -similarity[candidates], tier[candidates]))
+        return [self.names[i] for i in candidates[order][:limit]]
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+
+################################################
+################################################
+
+# Spatial binning for the Dynamic Map
+
+# Square grid cell sizes in meters, from the finest to the coarsest (the ones the zoom slider
+# of the Dynamic Map, 9 to 13, can pick)
+CELL_SIZES = [250, 500, 1000, 2000]
+
+# Size a grid cell should roughly take on screen, used to pick the resolution from the zoom
+BIN_PIXELS = 12
+
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+
+
+def column_colors(counts, max_entry):
+    # RGBA color of each column, from purple (low) to black (max)
+    scale = np.clip(np.nan_to_num(counts) / max_entry, 0, 1) if max_entry else np.zeros(len(counts))
+    colors = np.empty((len(counts), 4), dtype=np.uint8)
+    colors[:, 0] = 135 - scale * 135
+    colors[:, 1] = 0
+    colors[:, 2] = 255 - scale * 255
+    colors[:, 3] = 255
+    return colors
+
+
+def change_colors(change, low=-100, high=50):
+    # RGBA color of each column from its percent change: red for drops, teal for gains, grey around 0
+    change = np.nan_to_num(change)
+    neutral = np.array([200, 200, 200])
+    drop = np.clip(change / low, 0, 1)[:, None]
+    gain = np.clip(change / high, 0, 1)[:, None]
+    rgb = neutral + drop * (np.array([220, 50, 50]) - neutral) + gain * (np.array([28, 117, 117]) - neutral)
+
+    colors = np.full((len(change), 4), 255, dtype=np.uint8)
+    colors[:, :3] = rgb
+    return colors
+
+
+class SpatialBins:
+    # Daily station entries summed into square grids at several resolutions, built once per data
+    # version so a map frame is a row lookup in a (day x bin) matrix.
+
+    def __init__(self, coords, counts_df, cell_sizes=CELL_SIZES):
+        self.cell_sizes = list(cell_sizes)
+        self.dates = counts_df.index
+
+        # One location per (stop_name, coordinates), counts of a name shared by several
+        # locations are split evenly so bin totals add up to the daily totals
+        stations = coords.dropna().drop_duplicates()
+        stations = stations[stations["stop_name"].isin(counts_df.columns)]
+        share = 1 / stations.groupby("stop_name")["stop_name"].transform("size").to_numpy()
+        counts = np.nan_to_num(counts_df[stations["stop_name"]].to_numpy(dtype=float)) * share
+        self.stop_names = stations["stop_name"].to_numpy()
+        self.share = share
+
+        # Largest daily count of a station, the tallest column of the station mode
+        self.station_max = np.nanmax(counts_df.to_numpy(dtype=float), initial=0)
+
+        # Local planar coordinates in meters
+        self.latitude = stations["gtfs_latitude"].mean()
+        self.lon_scale = METERS_PER_DEGREE_LON * np.cos(np.radians(self.latitude))
+        x = stations["gtfs_longitude"].to_numpy() * self.lon_scale
+        y = stations["gtfs_latitude"].to_numpy() * METERS_PER_DEGREE_LAT
+
+        self.grids = {}
+        self.bin_max = {}
+        for cell_size in self.cell_sizes:
+            cells = np.stack([np.floor(x / cell_size), np.floor(y / cell_size)], axis=1)
+            keys, bin_ids = np.unique(cells, axis=0, return_inverse=True)
+            bin_ids = bin_ids.ravel()
+
+            # Sum the station columns of each bin in one pass
+            order = np.argsort(bin_ids, kind="stable")
+            starts = np.searchsorted(bin_ids[order], np.arange(len(keys)))
+            totals = np.add.reduceat(counts[:, order], starts, axis=1) if len(keys) else counts[:, :0]
+
+            centers = pd.DataFrame({
+                "gtfs_longitude": (keys[:, 0] + 0.5) * cell_size / self.lon_scale,
+                "gtfs_latitude": (keys[:, 1] + 0.5) * cell_size / METERS_PER_DEGREE_LAT,
+            })
+            self.grids[cell_size] = (centers, totals, order, starts)
+            self.bin_max[cell_size] = totals.max(initial=0)
+
+    def pick_cell_size(self, zoom, bin_pixels=BIN_PIXELS):
+        # Cell size closest (in log scale) to bin_pixels at this zoom level
+        meters_per_pixel = 156543.03 * np.cos(np.radians(self.latitude)) / 2 ** zoom
+        target = bin_pixels * meters_per_pixel
+        return min(self.cell_sizes, key=lambda cell_size: abs(np.log(cell_size / target)))
+
+    def elevation_factor(self, cell_size):
+        # Bins sum their stations, so coarser grids are scaled down: the tallest bin of every
+        # resolution is as tall as the tallest station
+        return self.station_max / self.bin_max[cell_size] if self.bin_max[cell_size] else 1.0
+
+    def bin_sums(self, cell_size, station_values):
+        # Sum a value given per stop name (Series) over the bins of a grid
+        centers, totals, order, starts = self.grids[cell_size]
+        values = station_values.reindex(self.stop_names).fillna(0).to_numpy(dtype=float) * self.share
+        return np.add.reduceat(values[order], starts) if len(starts) else values[:0]
+
+    def frame(self, cell_size, date, station_change=None, station_counts=None):
+        # Non-empty bins of one day, with their counts and colors. With station_change (actual and
+        # expected entries per stop name) bins are colored by their percent change instead.
+        # station_counts (per stop name, e.g. one intra-day bucket) replace the daily totals.
+        centers, totals, order, starts = self.grids[cell_size]
+        if station_counts is None:
+            values = totals[self.dates.get_loc(date)]
+        else:
+            values = self.bin_sums(cell_size, station_counts)
+        keep = values > 0
+
+        bins = centers[keep].reset_index(drop=True)
+        bins["counts"] = values[keep]
+
+        if station_change is None:
+            bins["color"] = column_colors(bins["counts"].to_numpy(), values.max()).tolist()
+            return bins
+
+        actual = self.bin_sums(cell_size, station_change["actual"])[keep]
+        expected = self.bin_sums(cell_size, station_change["expected"])[keep]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bins["change"] = 100 * (actual / expected - 1)
+        bins["color"] = change_colors(bins["change"].to_numpy()).tolist()
+        return bins
@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+
+################################################
+################################################
+
+# Data versions
+
+# Immutable pair handed to the pages: reruns keep the snapshot they started with
+Snapshot = namedtuple("Snapshot", ["version", "data"])
+
+
+def file_stats(paths):
+    # Cheap change detection: modification time and size of every watched file
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stats.append(None)
+    return tuple(stats)
+
+
+def content_hash(paths, chunk_size=1 << 20):
+    # Version identifier: hash of the content of every watched file
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class DataVersionManager:
+    # Watches source files and swaps in a freshly loaded snapshot when their content changes.
+    # The loader runs in a background thread, the current snapshot is replaced in one assignment
+    # so a rerun that already grabbed it finishes on the old version.
+
+    def __init__(self, paths, loader, poll_interval=60):
+        self.paths = list(paths)
+        self.loader = loader
+        self.poll_interval = poll_interval
+
+        self._stats = file_stats(self.paths)
+        self._snapshot = Snapshot(content_hash(self.paths), loader())
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._watch, daemon=True,
+                                        name=f"data-version-watch-{os.path.basename(self.paths[0])}")
+        self._thread.start()
+
+    def current(self):
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def check(self):
+        # Reload if the watched files changed, returns True when a new snapshot was swapped in
+        stats = file_stats(self.paths)
+        if stats == self._stats:
+            return False
+
+        with self._lock:
+            self._stats = stats
+            version = content_hash(self.paths)
+            if version == self._snapshot.version:
+                return False
+
+            try:
+                data = self.loader()
+            except Exception:
+                logger.exception("Reloading %s failed, keeping version %s", self.paths, self._snapshot.version)
+                return False
+
+            # Files still being written: wait for the next poll to load a consistent version
+            if file_stats(self.paths) != stats:
+                self._stats = None
+                return False
+
+            self._snapshot = Snapshot(version, data)
+            logger.info("Loaded data version %s from %s", version, self.paths)
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Watching %s failed", self.paths)
@@ -0,0 +1,35 @@
+import streamlit as st
+from streamlit_searchbox import st_searchbox
+
+from bridge.search import SEARCH_LIMIT
+
+
+################################################
+################################################
+
+# Search-as-you-type selector
+
+def search_multiselect(label, index, key, allowed=None, limit=SEARCH_LIMIT):
+    # Search box sending only the best `limit` matches to the browser, each pick is added to a
+    # multiselect holding the picked names only (so its options stay small too). The multiselect
+    # is keyed like the search box, its session state holds the picks across reruns.
+    picked_key = f"{key}_picked"
+    if picked_key not in st.session_state:
+        st.session_state[picked_key] = []
+
+    # Forget picks that the upstream filters no longer allow
+    if allowed is not None:
+        st.session_state[picked_key] = [name for name in st.session_state[picked_key]
+                                        if name in index.positions and allowed[index.positions[name]]]
+
+    def pick(name):
+        if name and name not in st.session_state[picked_key]:
+            st.session_state[picked_key] = st.session_state[picked_key] + [name]
+
+    st_searchbox(lambda term: index.search(term, limit, allowed),
+                 placeholder=f"Search {label.lower()}...", label=label,
+                 default_options=index.search("", limit, allowed),
+                 clear_on_submit=True, submit_function=pick, key=f"{key}_search")
+
+    return st.multiselect(label, options=st.session_state[picked_key], key=picked_key,
+                          label_visibility="collapsed")
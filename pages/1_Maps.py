@@ -4,12 +4,22 @@ import pandas as pd
 import pydeck as pdk
 import altair as alt
 import plotly.express as px
-from PIL import Image
 import random
 import time
 from datetime import datetime as dt, timedelta
 from itertools import cycle
 import json
+import os
+
+from bridge.aggregates import aggregate_nta, filter_nta
+from bridge.api import start_server
+from bridge.assets import page_assets
+from bridge.baseline import default_reference
+from bridge.data import intraday_versions, nta_versions, station_versions
+from bridge.figures import FigureSkeletons, log_figure_size
+from bridge.intraday import BUCKET_LABELS
+from bridge.prerender import FrameStore, frame_style
+from bridge.widgets import search_multiselect
 
 
 ################################################
@@ -17,26 +27,8 @@ import json
 
 # Functions
 
-# DYN MAP
-@st.cache_data
-def load_data():
-    # coordinates for each station
-    data = pd.read_csv('input/clean_data.csv', low_memory=False)
-    coords = data[["gtfs_latitude", "gtfs_longitude", "stop_name"]]
-
-    # pivot table showing daily entries for each station
-    counts_df = pd.read_csv('input/station_entry_pivot.csv', parse_dates=['date'],
-                            index_col="date")
-
-
-    return data, coords, counts_df
-
-# CHORO MAP
-@st.cache_data
-def load_map_data_daily():
-    map_data = pd.read_csv('output/nta_fulldata_d.csv')
-
-    return map_data
+# Data is loaded once per process by version managers (see bridge/data.py), which reload
+# it in the background when the source files change
 
 
 ################################################
@@ -45,15 +37,15 @@ def load_map_data_daily():
 # Page parameters
 
 # Setup page layout
-icon = Image.open("objects/bridge_icon.png")
+# Icon and CSS, optimized and loaded once per process (see bridge/assets.py)
+assets = page_assets()
 
 st.set_page_config(page_title="Bridge - NYC Subway Traffic Dataset",
-                   layout="wide", page_icon=icon)
+                   layout="wide", page_icon=assets.icon)
 
 
 # Set Body, Header and Sidebar background
-with open("filtered_style.css") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+st.markdown(assets.style, unsafe_allow_html=True)
 
 
 st.sidebar.header("Parameters")
@@ -61,16 +53,60 @@ st.sidebar.header("Parameters")
 ################################################
 ################################################
 
+# Take the current data versions, kept for the whole rerun even if new ones are swapped in
+station_snapshot = station_versions().current()
+data_df, coords_df, counts_df_df, spatial_bins, station_changes = station_snapshot.data
+
+# Memory-mapped intra-day entries (None until built with `python -m bridge.intraday`)
+intraday_snapshot = intraday_versions().current()
+intraday = intraday_snapshot.data
+
+# Dynamic Map frames, pre-rendered by `python -m bridge.prerender` or built on the first request
+@st.cache_resource
+def load_frame_store():
+    return FrameStore()
+
+frame_store = load_frame_store()
+
+class FrameDeck(pdk.Deck):
+    # Deck serialized on first use only, the frame store hands the same one to every rerun
+    def to_json(self):
+        if getattr(self, "_json", None) is None:
+            self._json = super().to_json()
+        return self._json
+
+# NTA polygons, read once per process
+@st.cache_resource
+def load_nta_geojson():
+    with open("input/nyc_nta.json") as f:
+        geojson = json.load(f)
+
+    # Merge the dataframe with the GeoJSON features based on a common identifier
+    for feature in geojson["features"]:
+        feature['id'] = feature['properties']['NTACode']  # adjust 'NTACode' to match the data
+    return geojson
+
+# Figure layouts and styling, built once per process (see bridge/figures.py)
+@st.cache_resource
+def load_figure_skeletons():
+    return FigureSkeletons()
+
+figure_skeletons = load_figure_skeletons()
+
+# Optional JSON API served from this process, over the same data (set BRIDGE_API_PORT to enable)
+if os.environ.get("BRIDGE_API_PORT"):
+    start_server(int(os.environ["BRIDGE_API_PORT"]))
+
 # Sidebar parameters and their session state
 date_format = "%Y-%m-%d"
-# Date input
-initial_end_date = pd.to_datetime("2020-06-30", format = date_format)
-initial_start_date = pd.to_datetime("2020-01-01", format = date_format)
+# Date input, bounds come from the dataset
+initial_end_date = counts_df_df.index.max()
+initial_start_date = counts_df_df.index.min()
 
-# Initialize session_state variables
-if 'start_date' not in st.session_state:
+# Initialize session_state variables (and clamp them if a new data version moved the bounds)
+if 'start_date' not in st.session_state or not initial_start_date <= st.session_state.start_date < initial_end_date:
     st.session_state.start_date = initial_start_date
-if 'end_date' not in st.session_state:
+if 'end_date' not in st.session_state or not st.session_state.start_date < st.session_state.end_date <= initial_end_date:
     st.session_state.end_date = initial_end_date
 
 
@@ -88,6 +124,11 @@ end_date = pd.to_datetime(st.sidebar.date_input('Select an end start:', value=st
                                 min_value=start_date + timedelta(days=1),
                                 max_value=initial_end_date))
 
+# Reference window of the pre-COVID baseline used by the percent change views
+reference = st.sidebar.date_input('Baseline period:', value=default_reference(station_changes.dates),
+                                  min_value=initial_start_date, max_value=initial_end_date)
+reference = tuple(pd.to_datetime(list(reference))) if len(reference) == 2 else default_reference(station_changes.dates)
+
 st.sidebar.text("")
 
 # Update session_state variables
@@ -104,8 +145,6 @@ st.write("###")
 st.write("---")
 
 
-data_df, coords_df, counts_df_df = load_data()
-
 # Defining each graph's function
 
 
@@ -113,12 +152,7 @@ def render_df_map():
 
     # Load your data
     # -> caching original data load and calling a copy of it prevents reloading data with every user interaction
-    map_df = load_map_data_daily()
-
-    filtered_map_df = map_df.copy()
-    filtered_map_df['date'] = pd.to_datetime(filtered_map_df['date'], format = date_format)
-
-    filtered_map_df = filtered_map_df[filtered_map_df["date"].between(start_date, end_date)]
+    map_df, nta_changes, nta_names, nta_search = nta_versions().current().data
 
 
     ##################################
@@ -131,7 +165,7 @@ def render_df_map():
 
     selected_boroughs = column_list[0].multiselect(
     "Select borough",
-    options=sorted(filtered_map_df['borough'].dropna().unique()),
+    options=sorted(nta_names['borough'].dropna().unique()),
     default=[]
     )
 
@@ -160,8 +194,7 @@ def render_df_map():
         centroid_lat, centroid_lon = 40.7128, -74.0060  # Default to New York
 
     # Filtering the dataframe
-    if selected_boroughs:
-        filtered_map_df = filtered_map_df[filtered_map_df['borough'].isin(selected_boroughs)]
+    filtered_map_df = filter_nta(map_df, start_date, end_date, selected_boroughs)
 
 
 
@@ -170,16 +203,15 @@ def render_df_map():
     # Select the metric to influence the map's color scale
     metrics = {"Entries": "entries",
                "Population": "population",
-               "Log-Ratio of Entries / Population (parks & cemiteries not included)": "entries_ratio"}
+               "Log-Ratio of Entries / Population (parks & cemiteries not included)": "entries_ratio",
+               "Change vs baseline (%)": "entries_change"}
     selected_metric = column_list[1].selectbox("Choose a metric", list(metrics.keys()))
 
     #######
-    # Select any station to exclue (outliers mess with the coloring)
-    stations = filtered_map_df.sort_values("entries", ascending=False).NTAName.unique()
-    selected_exclude = column_list[2].multiselect("Exclude a station",options=stations)
-
-    # Apply station filter to dataframe
-    filtered_map_df = filtered_map_df[~filtered_map_df['NTAName'].isin(selected_exclude)].reset_index(drop=True)
+    # Select any station to exclue (outliers mess with the coloring), busiest ones suggested first
+    allowed = nta_names['borough'].isin(selected_boroughs).to_numpy() if selected_boroughs else None
+    with column_list[2]:
+        selected_exclude = search_multiselect("Exclude a station", nta_search, "exclude_nta", allowed=allowed)
 
     som_options = {"Sum": "sum",
                    "Mean": "mean"}
@@ -189,49 +221,45 @@ def render_df_map():
     if selected_metric== "Entries":
         st.session_state.sum_or_mean = column_list[3].selectbox("Sum or Mean", list(som_options.keys()))
 
-    # Group the dataframe to map all selected fields over the date interval (apply sum_or_mean option)
-    filtered_map_df = filtered_map_df.groupby("NTACode").agg({
-        'NTAName': 'first',
-        'borough': 'first',
-        'entries': som_options[st.session_state.sum_or_mean] if st.session_state.sum_or_mean in som_options else 'sum',
-        'population': 'last',
-        'entries_ratio': 'mean',
-        'geometry': 'first'}).reset_index()
-
-    # Reordering columns
-    filtered_map_df = filtered_map_df[["NTAName", "borough", "entries",
-                                       "population", "entries_ratio", "NTACode",
-                                       "geometry"]]
-
-    # Load GeoJSON file
-    with open("input/nyc_nta.json") as f:
-        geojson = json.load(f)
+    # Apply station filter and group the dataframe over the date interval (apply sum_or_mean option)
+    filtered_map_df = aggregate_nta(filtered_map_df, selected_exclude,
+                                    som_options.get(st.session_state.get('sum_or_mean'), 'sum'))
 
-    # Merge the dataframe with the GeoJSON features based on a common identifier
-    for feature in geojson["features"]:
-        feature['id'] = feature['properties']['NTACode']  # adjust 'NTACode' to match the data
+    # Change of the entries over the period against the baseline of the sidebar's reference period
+    filtered_map_df["entries_change"] = filtered_map_df["NTACode"].map(
+        nta_changes.period_change(reference, start_date, end_date)).round(1)
 
     # Set a zoom if only one borough selected, zoom back out if more
     map_zoom = 9
     if len(selected_boroughs) == 1:
         map_zoom = 9.5
 
-    fig = px.choropleth_mapbox(filtered_map_df,
-                            geojson=geojson,
-                            locations='NTACode', # change to your identifier column
-                            color=metrics[selected_metric], # or 'entries' or 'entries_ratio'
-                            featureidkey="properties.NTACode", # matches the identifier column in the GeoJSON
-                            hover_data="NTAName",
-                            color_continuous_scale="purples_r",
-                            mapbox_style="carto-darkmatter",
-                            center={"lat": centroid_lat, "lon": centroid_lon},
-                            zoom=map_zoom)
-
-
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0},
-                    width=1000, height=500,
-                    plot_bgcolor="rgba(0,0,0,0)",
-                    paper_bgcolor="rgba(0,0,0,0)",)
+    # Static part of the map (polygons, color scale, styling), built once per process for each metric
+    def build_map():
+        fig = px.choropleth_mapbox(pd.DataFrame({'NTACode': [''], metrics[selected_metric]: [0], 'NTAName': ['']}),
+                                geojson=load_nta_geojson(),
+                                locations='NTACode', # change to your identifier column
+                                color=metrics[selected_metric], # or 'entries' or 'entries_ratio'
+                                featureidkey="properties.NTACode", # matches the identifier column in the GeoJSON
+                                hover_data="NTAName",
+                                color_continuous_scale="RdBu" if selected_metric == "Change vs baseline (%)" else "purples_r",
+                                color_continuous_midpoint=0 if selected_metric == "Change vs baseline (%)" else None,
+                                mapbox_style="carto-darkmatter")
+
+
+        fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0},
+                        width=1000, height=500,
+                        plot_bgcolor="rgba(0,0,0,0)",
+                        paper_bgcolor="rgba(0,0,0,0)",)
+        return fig
+
+    fig = figure_skeletons.figure(("nta_map", selected_metric), build_map,
+                                  [{"locations": filtered_map_df['NTACode'].tolist(),
+                                    "z": filtered_map_df[metrics[selected_metric]].to_numpy(),
+                                    "customdata": filtered_map_df[['NTAName']].to_numpy()}],
+                                  layout=dict(mapbox_center={"lat": centroid_lat, "lon": centroid_lon},
+                                              mapbox_zoom=map_zoom))
+    log_figure_size("nta_map", fig)
 
     df_display, map_display = st.columns([2,3])
 
@@ -249,9 +277,8 @@ def render_df_map():
 def dynamic_map():
     global animation_speed
 
-    # Use a dataframe copy to allow modifications
-    coords = coords_df.copy()
-    counts_df = counts_df_df.copy()
+    # Shared snapshot data, only read (no copy needed)
+    counts_df = counts_df_df
 
     year_month_day_values = [(d.year, d.month, d.day) for d in counts_df.index if start_date <= d <= end_date]
     year, month, day = year_month_day_values[0]
@@ -298,57 +325,76 @@ def dynamic_map():
         return year, month, day
 
     def render_map(year, month, day):
-        mask = (counts_df.index.year == year) & (counts_df.index.month == month) & (counts_df.index.day == day)
-        daily_counts = counts_df[mask].transpose().reset_index()
-        daily_counts.rename(
-            columns={
-                daily_counts.columns[0]: "name",
-                daily_counts.columns[1]: "daily_counts",
-            },
-            inplace=True,
-        )
-
-        coords["counts"] = coords.merge(
-            daily_counts, left_on="stop_name", right_on="name", how="left"
-        )["daily_counts"]
-
-        max_entry = daily_counts["daily_counts"].max()
-
-        display_counts = coords[~pd.isna(coords["counts"])]
-
-        if display_counts.empty:
+        if display_mode == "Grid":
+            # Pre-aggregated bins at the resolution matching the zoom
+            cell_size = spatial_bins.pick_cell_size(map_zoom)
+            style = frame_style("Grid", cell_size, color_by, reference, bucket)
+            # Square columns filling their cell
+            radius = cell_size / np.sqrt(2)
+            disk_resolution = 4
+            angle = 45
+            # Heights normalized per resolution, the same as the stations for the tallest bin
+            elevation_scale = 0.12 * spatial_bins.elevation_factor(cell_size)
+        else:
+            style = frame_style("Stations", color_by=color_by, reference=reference, bucket=bucket)
+            radius = 100
+            disk_resolution = 12
+            angle = 0
+            elevation_scale = 0.12
+
+        def build_deck(display_counts):
+            if display_counts.empty:
+                return None
+
+            # Create Pydeck's initial view
+            return FrameDeck(
+                    map_style="mapbox://styles/mapbox/dark-v9",
+                    initial_view_state=pdk.ViewState(
+                        latitude=(display_counts.gtfs_latitude.mean()+0.03),
+                        longitude=display_counts.gtfs_longitude.mean(),
+                        zoom=map_zoom,
+                        pitch=40,
+                        height=630,
+                        width=550
+                    ),
+                    # Add a layer to the view
+                    layers=[
+                        pdk.Layer(
+                            "ColumnLayer",
+                            data=display_counts,
+                            disk_resolution=disk_resolution,
+                            radius=radius,
+                            angle=angle,
+                            get_position="[gtfs_longitude, gtfs_latitude]",
+                            # Colors are computed per column in NumPy, the layer spec stays the same every frame
+                            get_fill_color="color",
+                            get_elevation="[counts]",
+                            coverage=4 if display_mode == "Stations" else 1,
+                            getElevation=True,
+                            elevation_scale=elevation_scale,
+                            elevation_range=[0, 8],
+                            pickable=True,
+                            wireframe=True,
+                        ),
+                    ],
+                )
+
+        # Shared deck of this day, style and zoom, built and serialized once for every viewer.
+        # Frames colored against another baseline period than the default one are only kept in memory.
+        persist = color_by == "Entries" or reference == default_reference(station_changes.dates)
+        if bucket is None:
+            deck = frame_store.view(station_snapshot.data, station_snapshot.version, dt(year, month, day), style,
+                                    map_zoom, build_deck, persist=persist)
+        elif dt(year, month, day) in intraday.dates:
+            version = f"{station_snapshot.version}.{intraday_snapshot.version}"
+            deck = frame_store.view(station_snapshot.data, version, dt(year, month, day), style,
+                                    map_zoom, build_deck, intraday)
+        else:
+            map_placeholder.info("No intra-day entries for this day")
             return
 
-        # Create Pydeck's initial view
-        deck = pdk.Deck(
-                map_style="mapbox://styles/mapbox/dark-v9",
-                initial_view_state=pdk.ViewState(
-                    latitude=(display_counts.gtfs_latitude.mean()+0.03),
-                    longitude=display_counts.gtfs_longitude.mean(),
-                    zoom=9.8,
-                    pitch=40,
-                    height=630,
-                    width=550
-                ),
-                # Add a layer to the view
-                layers=[
-                    pdk.Layer(
-                        "ColumnLayer",
-                        data=display_counts,
-                        disk_resolution=12,
-                        radius=100,
-                        get_position="[gtfs_longitude, gtfs_latitude]",
-                        get_fill_color=f'[135-(counts*(135/{max_entry})),0,255-(counts*(255/{max_entry})),255]',
-                        get_elevation="[counts]",
-                        coverage=4,
-                        getElevation=True,
-                        elevation_scale=0.12,
-                        elevation_range=[0, 8],
-                        pickable=True,
-                        wireframe=True,
-                    ),
-                ],
-            )
+        if deck is None:
+            return
 
         map_placeholder.pydeck_chart(deck)
 
@@ -359,6 +405,22 @@ def dynamic_map():
                         "Slow": 1}
         selected_speed = st.selectbox("Choose a speed", list(speed_options.keys()))
 
+        # Grid mode sums stations into square bins, sized according to the zoom
+        display_mode = st.radio("Show entries by", ["Stations", "Grid"], horizontal=True)
+        map_zoom = st.slider("Zoom", min_value=9.0, max_value=13.0, value=9.8, step=0.2)
+
+        # Whole days, or the entries of one 4-hour bucket once the intra-day data is built
+        bucket = None
+        if intraday is not None:
+            time_of_day = st.selectbox("Time of day", ["All day"] + BUCKET_LABELS)
+            if time_of_day != "All day":
+                bucket = BUCKET_LABELS.index(time_of_day)
+
+        # Color by entries, or by the rolling change against the baseline (red: drop, teal: gain)
+        color_by = st.radio("Color by", ["Entries", "Change vs baseline"], horizontal=True,
+                            disabled=bucket is not None,
+                            help="Intra-day columns are colored by entries" if bucket is not None else None)
+
     # Animation start and stop button
     with col2:
         one, two = st.columns(2)